@@ -20,6 +20,7 @@ QUACLIB = os.path.abspath(os.path.dirname(__file__) + '/../../lib')
 sys.path.insert(0, QUACLIB)
 
 import forecast
+import math_
 import timeseries
 import u
 
@@ -145,8 +146,7 @@ def main():
    #     key: Context
    #     val: Priority_Queue:
    #             pri:  r [correlation with ground truth on training data]
-   #             val:  (Series [complete time series, .name is URL],
-   #                    Series [shifted/truncated training data, .name is URL])
+   #             val:  Series [complete time series, .name is URL]
    cands = shards.flatMap(candidates_read)
 
    # 2b. Find global top candidates for each context
@@ -261,7 +261,7 @@ def main():
 
 def candidate_summarize(kv):
    (ctx, pq) = kv
-   articles = [ (full.name, r) for (r, (full, train)) in pq.items() ]
+   articles = [ (full.name, r) for (r, full) in pq.items() ]
    articles.sort()
    return (ctx.outbreak, { (ctx.training_duration,
                             ctx.horizon_duration,
@@ -272,8 +272,12 @@ def candidates_merge(pq_a, pq_b):
 
 def candidates_read(worker_i):
    start = time.time()
-   cands = [(ctx, u.Priority_Queue(args_b.value.candidates))
-            for ctx in tests_b.value]
+   ctxs = tests_b.value
+   cands = [(ctx, u.Priority_Queue(args_b.value.candidates)) for ctx in ctxs]
+   (horizons, ctx_h, pos, truths) = contexts_stack(ctxs)
+   index = truth_b.value.index
+   # Lowest correlation that can still get into each context's queue.
+   floors = np.full(len(ctxs), -np.inf)
    for (i, full) in enumerate(input_read(worker_i)):
       if (i >= args_b.value.limit):
          break
@@ -282,20 +286,49 @@ def candidates_read(worker_i):
       # small-sample problems when there is only modest real overlap between
       # the time series and the truth because there are a lot of NaNs.
       full.fillna(0, inplace=True)
-      last_ctx = None
-      for (ctx, pq) in cands:
-         if (not ctx.time_eq(last_ctx)):
-            trim = ctx.alignshift(full)
-          # Ignore traffic chunks that are all zero (because the flat pattern
-          # is unlikely to be real)
-         if (np.count_nonzero(trim.values) > 0):
-            pq.add(ctx.corr(trim), (full, trim))
-         last_ctx = ctx
+      # Shift once per horizon, then gather every context's training window
+      # into one row each, so all contexts are correlated in one operation.
+      # The extra column of NaN is where padding in pos points.
+      shifted = np.full((len(horizons), len(index) + 1), np.nan)
+      for (k, h) in enumerate(horizons):
+         shifted[k, :-1] = full.shift(h).reindex(index).values
+      hits = shifted[ctx_h[:, None], pos]
+      rs = math_.pearson_many(hits, truths)
+      # Ignore traffic chunks that are all zero (because the flat pattern is
+      # unlikely to be real), as well as correlations that can't be computed
+      # (pearson_many() returns 0 where Series.corr() returns NaN).
+      live = np.where(pos < len(index), hits != 0, False).any(axis=1)
+      for j in np.flatnonzero(live & (rs != 0) & (rs > floors)):
+         (ctx, pq) = cands[j]
+         pq.add(rs[j], full)
+         if (len(pq) == pq.limit):
+            floors[j] = min(pq.priorities())
    cands = [i for i in cands if len(i[1]) > 0]
    article_ct.add(i + 1)
    eval_elapsed.add(time.time() - start)
    return cands
 
+def contexts_stack(ctxs):
+   '''Return arrays for correlating an article with all of ctxs at once:
+
+        horizons  sorted list of distinct forecast horizons
+        ctx_h     index into horizons of each context's horizon
+        pos       (contexts x longest training) array of indexes into the
+                  truth index of each context's training window, padded
+                  with len(index)
+        truths    same shape as pos; truth over each training window,
+                  padded with NaN'''
+   index_len = len(truth_b.value.index)
+   width = max(ctx.training for ctx in ctxs)
+   horizons = sorted({ ctx.horizon for ctx in ctxs })
+   ctx_h = np.array([horizons.index(ctx.horizon) for ctx in ctxs])
+   pos = np.full((len(ctxs), width), index_len)
+   truths = np.full((len(ctxs), width), np.nan)
+   for (j, ctx) in enumerate(ctxs):
+      pos[j, :ctx.training] = np.arange(ctx.now - ctx.training, ctx.now)
+      truths[j, :ctx.training] = ctx.truth.values
+   return (horizons, ctx_h, pos, truths)
+
 def input_read(worker_i):
    if (not args_b.value.sin):
       # real data
@@ -317,9 +350,9 @@ def input_read(worker_i):
 
 def model_build(kv):
    (ctx, pq) = kv
-   (full, train) = zip(*pq.values())
+   full = list(pq.values())
    df_full = pd.concat(full, axis=1)
-   df_train = pd.concat(train, axis=1)
+   df_train = pd.concat([ctx.alignshift(f) for f in full], axis=1)
    df_full.fillna(0, inplace=True)  # NaNs crash fitting and prediction
    df_train.fillna(0, inplace=True)
    m = ctx.fit(df_train)
@@ -377,7 +410,6 @@ def tests_enumerate():
          # training period and sufficient time after for at least one test.
          for i in forecast.nows(truedata_ct, tr, ho, args.teststride):
             for (obk, truedata) in truth.items():
-               # Outbreaks in the inner loop to they can share trim and shift.
                assert (truedata_ct == len(truedata))
                tests.append(forecast.Context(truth_b.value, obk, tr, ho, i))
    return tests
@@ -0,0 +1,251 @@
+'''Store many sparse daily time series, e.g. n-gram counts, in a compressed
+   sparse row (CSR) format that can be memory-mapped and searched directly.
+
+   Most n-grams occur on only a few days, so rather than a full vector per
+   series, we store the nonzero days and values of all series end to end,
+   plus a pointer to where each series starts. A store is a directory
+   containing the following files, all little-endian:
+
+   * ``keys.utf8``, ``keys.off``: The keys of the series, in ascending order
+     (of their UTF-8 encodings, i.e., as ``LC_ALL=C sort``), concatenated,
+     and n+1 int64 offsets into that.
+   * ``indptr``: n+1 int64; the days and values of row i are at
+     ``indptr[i]:indptr[i+1]`` in the next two files.
+   * ``days``: int32 proleptic Gregorian ordinals, ascending within a row.
+   * ``values``: float32.
+   * ``totals``: int64, one per row.
+   * ``csr``: a magic line, then the number of rows and of nonzero values.
+     This is written last, so a store without it is incomplete.
+
+   Leading, trailing, and interior zeroes are not stored, so a series comes
+   back spanning only its first through last nonzero days.'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import collections
+import datetime
+import io
+import mmap
+import os
+
+import numpy as np
+
+import math_
+import testable
+
+
+MAGIC = 'quac-csr-series 1'
+
+# Rows to buffer when writing, and per block when reading.
+BLOCK_SIZE = 65536
+
+
+Block = collections.namedtuple('Block', ('keys', 'totals', 'indptr', 'days',
+                                         'values'))
+
+
+class Reader(object):
+   '''Read a store. For example:
+
+      >>> import tempfile
+      >>> d = tempfile.mkdtemp()
+      >>> w = Writer(d)
+      >>> w.write('a', 3, math_.Date_Vector('2013-06-02', np.array([2, 0, 1])))
+      >>> w.write('b', 5, math_.Date_Vector('2013-06-04', np.array([5])))
+      >>> w.write('早', 1, math_.Date_Vector('2013-06-01', np.array([0, 1])))
+      >>> w.close()
+      >>> r = Reader(d)
+      >>> len(r)
+      3
+      >>> for (key, total, s) in r:
+      ...    print(key, total, s.first_day, s.tolist())
+      a 3 2013-06-02 [2.0, 0.0, 1.0]
+      b 5 2013-06-04 [5.0]
+      早 1 2013-06-02 [1.0]
+      >>> (total, s) = r['b']
+      >>> (total, s.first_day, s.tolist())
+      (5, datetime.date(2013, 6, 4), [5.0])
+      >>> r.get('c') is None
+      True
+
+      Blocks are raw slices of the arrays, with indptr rebased to zero:
+
+      >>> [(b.keys, b.indptr.tolist()) for b in r.blocks(2)]
+      [(['a', 'b'], [0, 2, 3]), (['早'], [0, 1])]'''
+
+   __slots__ = ('dirname', 'count', 'nnz', 'key_offsets', 'key_data',
+                'indptr', 'days', 'values', 'totals')
+
+   def __init__(self, dirname):
+      self.dirname = dirname
+      with io.open(dirname + '/csr', 'rt') as fp:
+         if (fp.readline().rstrip('\n') != MAGIC):
+            raise ValueError('not a CSR series store: %s' % (dirname))
+         (self.count, self.nnz) = (int(i) for i in fp.readline().split())
+      self.key_offsets = self.memmap('keys.off', '<i8')
+      self.key_data = self.mmap_bytes('keys.utf8')
+      self.indptr = self.memmap('indptr', '<i8')
+      self.days = self.memmap('days', '<i4')
+      self.values = self.memmap('values', '<f4')
+      self.totals = self.memmap('totals', '<i8')
+
+   def __getitem__(self, key):
+      i = self.find(key)
+      if (i is None):
+         raise KeyError(key)
+      return self.row(i)
+
+   def __iter__(self):
+      for b in self.blocks():
+         (days, values) = (b.days, b.values)
+         indptr = b.indptr.tolist()
+         totals = b.totals.tolist()
+         for (i, key) in enumerate(b.keys):
+            (a, z) = (indptr[i], indptr[i+1])
+            yield (key, totals[i], series(days[a:z], values[a:z]))
+
+   def __len__(self):
+      return self.count
+
+   def blocks(self, size=BLOCK_SIZE):
+      '''Generator which yields the store as Block tuples of up to size rows,
+         for callers that want to work with the arrays directly.'''
+      for start in range(0, self.count, size):
+         end = min(start + size, self.count)
+         indptr = self.indptr[start:end+1].tolist()
+         (a, b) = (indptr[0], indptr[-1])
+         offsets = self.key_offsets[start:end+1].tolist()
+         yield Block([self.key_data[i:j].decode('utf8')
+                      for (i, j) in zip(offsets, offsets[1:])],
+                     self.totals[start:end],
+                     np.array(indptr) - a,
+                     self.days[a:b],
+                     self.values[a:b])
+
+   def find(self, key):
+      '''Return the row number of key, or None if it's not present. This is
+         a binary search, so it takes O(log n) time and reads only a few
+         pages of the store.'''
+      key = key.encode('utf8')
+      (lo, hi) = (0, self.count)
+      while (lo < hi):
+         mid = (lo + hi) // 2
+         k = self.key(mid, decode=False)
+         if (k < key):
+            lo = mid + 1
+         elif (k > key):
+            hi = mid
+         else:
+            return mid
+      return None
+
+   def get(self, key, default=None):
+      i = self.find(key)
+      return default if i is None else self.row(i)
+
+   def key(self, i, decode=True):
+      k = self.key_data[self.key_offsets[i]:self.key_offsets[i+1]]
+      return k.decode('utf8') if decode else k
+
+   def memmap(self, filename, dtype):
+      # np.memmap objects are much slower to index and slice than plain
+      # arrays, so wrap the mapping ourselves.
+      return np.frombuffer(self.mmap_bytes(filename), dtype=dtype)
+
+   def mmap_bytes(self, filename):
+      with io.open('%s/%s' % (self.dirname, filename), 'rb') as fp:
+         if (os.fstat(fp.fileno()).st_size == 0):
+            return b''
+         return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+   def row(self, i):
+      'Return the total and series of row i.'
+      (a, b) = (int(self.indptr[i]), int(self.indptr[i+1]))
+      return (int(self.totals[i]), series(self.days[a:b], self.values[a:b]))
+
+
+class Writer(object):
+   '''Write a store to directory dirname, which is created if needed
+      (existing content is overwritten). Rows must be written in key order.
+      E.g.:
+
+      >>> import tempfile
+      >>> w = Writer(tempfile.mkdtemp())
+      >>> w.write('b', 1, math_.Date_Vector('2013-06-02', np.array([1])))
+      >>> w.write('a', 1, math_.Date_Vector('2013-06-02', np.array([1])))
+      Traceback (most recent call last):
+        ...
+      ValueError: key a not after b'''
+
+   __slots__ = ('dirname', 'count', 'nnz', 'last_key', 'key_end', 'fps',
+                'bufs')
+
+   DTYPES = { 'keys.off': '<i8',
+              'indptr':   '<i8',
+              'days':     '<i4',
+              'values':   '<f4',
+              'totals':   '<i8' }
+
+   def __init__(self, dirname):
+      os.makedirs(dirname, exist_ok=True)
+      try:
+         os.unlink(dirname + '/csr')  # no longer complete
+      except FileNotFoundError:
+         pass
+      self.dirname = dirname
+      self.count = 0
+      self.nnz = 0
+      self.last_key = None
+      self.key_end = 0
+      self.fps = { f: io.open('%s/%s' % (dirname, f), 'wb')
+                   for f in list(self.DTYPES.keys()) + ['keys.utf8'] }
+      self.bufs = { f: list() for f in self.DTYPES.keys() }
+      self.bufs['keys.off'].append(0)
+      self.bufs['indptr'].append(0)
+
+   def close(self):
+      self.flush()
+      for fp in self.fps.values():
+         fp.close()
+      with io.open(self.dirname + '/csr', 'wt') as fp:
+         fp.write('%s\n%d %d\n' % (MAGIC, self.count, self.nnz))
+
+   def flush(self):
+      for (f, buf) in self.bufs.items():
+         if (len(buf) > 0 and isinstance(buf[0], np.ndarray)):
+            buf = np.concatenate(buf)
+         np.asarray(buf, dtype=self.DTYPES[f]).tofile(self.fps[f])
+         self.bufs[f] = list()
+
+   def write(self, key, total, series):
+      '''Append the row key with the given total and series (a Date_Vector),
+         which must have at least one nonzero value.'''
+      if (self.last_key is not None and key <= self.last_key):
+         raise ValueError('key %s not after %s' % (key, self.last_key))
+      self.last_key = key
+      nz = np.flatnonzero(series)
+      assert (len(nz) > 0)
+      self.key_end += self.fps['keys.utf8'].write(key.encode('utf8'))
+      self.nnz += len(nz)
+      self.count += 1
+      b = self.bufs
+      b['keys.off'].append(self.key_end)
+      b['indptr'].append(self.nnz)
+      b['days'].append(nz + series.first_day.toordinal())
+      b['values'].append(np.asarray(series)[nz])
+      b['totals'].append(total)
+      if (len(b['totals']) >= BLOCK_SIZE):
+         self.flush()
+
+
+def series(days, values):
+   '''Return a Date_Vector with the given values on the given days (in
+      proleptic Gregorian ordinals, ascending) and zero elsewhere.'''
+   first = int(days[0])
+   v = np.zeros(int(days[-1]) - first + 1, dtype=np.float32)
+   v[days - first] = values
+   return math_.Date_Vector(datetime.date.fromordinal(first), v)
+
+
+testable.register('')
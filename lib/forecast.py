@@ -119,6 +119,7 @@ except ImportError:
    sklearn.exceptions = lambda: None
    sklearn.exceptions.ConvergenceWarning = ConvergenceWarning
 
+import math_
 import testable
 import timeseries
 import u
@@ -194,6 +195,13 @@ class Context(object):
         >>> n.corr(tr)
         0.982...
 
+      Correlations at many horizons can be had at once; the horizon 0 and 2
+      results match this context and the 2-week forecasting context below:
+
+        >>> n.corr_shifts(hits.to_frame('h'), [0, 1, 2]).round(4)
+                0    1    2
+        h  0.9827  1.0  1.0
+
       2-week forecasting model with 4-week training period.
 
         >>> f = Context(truth, 'us+lycanthropy', 4, 2, 7)
@@ -378,6 +386,18 @@ class Context(object):
    def corr(self, data):
       return self.truth.corr(data)
 
+   def corr_shifts(self, hits, shifts):
+      '''Return a DataFrame with the correlation of self.truth with each
+         column of hits (a DataFrame with the same frequency as self.truth)
+         after alignshift() by each horizon in shifts, with one row per
+         column and one column per shift. This is equivalent to calling
+         corr() for each combination but much faster, since each column is
+         Fourier-transformed only once (see math_.pearson_lagged()). Unlike
+         corr(), correlations on too few data are 0 rather than NaN.'''
+      y = self.truth.reindex(hits.index).values
+      r = math_.pearson_lagged(hits.values.T, y, shifts)
+      return pd.DataFrame(r, index=hits.columns, columns=list(shifts))
+
    def error(self, preds, truth):
       '''Return error by prediction staleness.'''
       (p, t) = preds.align(truth, join='inner')
@@ -39,18 +39,33 @@ import base64
 import pickle as pickle
 import io
 import itertools
+import json
 import operator
+import os
+import platform
+import resource
+import shutil
 import sys
+import time
+
+import psutil
 
 import testable
 import tsv_glue
 import u
 
+from . import partition
+
 
 # We use a relatively large output buffer size; see also OUTPUT_BUFSIZE in
 # hashsplit.c.)
 OUTPUT_BUFSIZE = 4194304
 
+# Mappers that split their own output remember the partition of this many
+# keys, so that hashing (which is slow in Python) is mostly avoided for
+# repeated keys.
+PARTITION_CACHE_MAX = 1000000
+
 
 ### Helper functions ###
 
@@ -60,12 +75,28 @@ def decode(bytes_):
 def encode(value):
    return base64.b64encode(pickle.dumps(value, -1))
 
+def io_counters():
+   '''Return the number of bytes this process has read and written so far, as
+      a pair, or (None, None) if the OS won't tell us.'''
+   try:
+      ctrs = psutil.Process().io_counters()
+      return (ctrs.read_chars, ctrs.write_chars)
+   except (AttributeError, psutil.Error):
+      return (None, None)
+
 
 
 ### Classes ###
 
 class Job(object, metaclass=ABCMeta):
 
+   # If true, reduce output can be updated incrementally: reducing only new
+   # map output and combining the result with the existing output, key by
+   # key, using merge() gives the same answer as reducing everything. Such
+   # jobs also need reduce_item_key() and reduce_read_output(). quacreduce
+   # --update asks the job at setup time, so this can depend on params.
+   associative = False
+
    def __init__(self, params=None):
       # Note: Intepreting params involves a strange hack, because the user can
       # either pass a string-encoded dictionary or an arbitrary data structure
@@ -104,10 +135,54 @@ class Job(object, metaclass=ABCMeta):
       # sure why we do now when it's an instance method.
       self.outfp.flush()
 
+   def merge(self, key, old, new):
+      '''Return a reduce output item that combines items old and new, which
+         both have the given key. Needed only if :attr:`associative`.'''
+      assert False, 'unimplemented'
+
+   def merge_items(self, old, new):
+      '''Generator which merges two iterables of reduce output items, each
+         sorted by key (as reduce output is), yielding items in key order;
+         items with the same key in both are combined with :meth:`merge()`.
+         For example:
+
+         >>> j = Test_Job()
+         >>> j.reduce_item_key = lambda item: item[0]
+         >>> j.merge = lambda key, old, new: (key, old[1] + new[1])
+         >>> list(j.merge_items([('a', 1), ('c', 2)], [('b', 3), ('c', 4)]))
+         [('a', 1), ('b', 3), ('c', 6)]
+         >>> list(j.merge_items([], [('b', 3)]))
+         [('b', 3)]
+         >>> list(j.merge_items([('a', 1)], []))
+         [('a', 1)]'''
+      key = self.reduce_item_key
+      end = object()
+      old = iter(old)
+      new = iter(new)
+      o = next(old, end)
+      n = next(new, end)
+      while (o is not end or n is not end):
+         if (n is end or (o is not end and key(o) < key(n))):
+            yield o
+            o = next(old, end)
+         elif (o is end or key(n) < key(o)):
+            yield n
+            n = next(new, end)
+         else:
+            yield self.merge(key(o), o, n)
+            o = next(old, end)
+            n = next(new, end)
+
    @abstractmethod
    def map(self, item):
       '''FIXME generator yields key/value pairs'''
 
+   def map_finish(self):
+      '''Generator called after all input items have been mapped, which
+         yields zero or more further key/value pairs. Useful for mappers that
+         aggregate their output. The default yields nothing.'''
+      return iter(())
+
    def map_init(self):
       'Called before mapping begins.'
 
@@ -119,22 +194,68 @@ class Job(object, metaclass=ABCMeta):
       for i in self.infp:
          yield i
 
+   def map_metrics(self):
+      '''Return a dictionary of job-specific items to add to the map task
+         metrics (e.g., cache statistics). The default returns nothing.'''
+      return dict()
+
    def map_open_input(self):
       self.infp = io.open(sys.stdin.fileno(), 'rb')
 
    def map_open_output(self):
       self.outfp = io.open(sys.stdout.fileno(), 'wb')
 
-   def map_stdinout(self):
-      '''Connect myself to input and output and run my mapper.'''
+   def map_open_output_split(self, part_ct, basename, table=None):
+      '''Open part_ct output files basename/0, basename/1, etc., as hashsplit
+         does, and prepare to assign keys to them using the partition table
+         in file table (or by hash alone if None).'''
+      if (table is None):
+         self.partition_table = partition.Table.trivial(part_ct)
+      else:
+         self.partition_table = partition.Table.load(table)
+         assert (self.partition_table.part_ct == part_ct)
+      self.partition_cache = dict()
+      os.makedirs(basename, exist_ok=True)
+      self.outfps = [io.open('%s/%d' % (basename, i), 'wb',
+                             buffering=OUTPUT_BUFSIZE)
+                     for i in range(part_ct)]
+
+   def map_stdinout(self, metrics=None, mid=None, part_ct=None,
+                    basename=None, table=None):
+      '''Connect myself to input and output and run my mapper. If metrics is
+         given, write task metrics to that file (see :class:`Task_Metrics`),
+         identifying this mapper as mid. If part_ct is given, split output
+         into part_ct files under basename myself, instead of writing to
+         standard output for hashsplit (see :meth:`map_open_output_split`).'''
       #p = u.Profiler()
+      tm = Task_Metrics('map', mid)
       self.map_open_input()
-      self.map_open_output()
+      if (part_ct is None):
+         self.map_open_output()
+         write = self.map_write
+      else:
+         self.map_open_output_split(part_ct, basename, table)
+         write = self.map_write_split
       self.map_init()
+      in_ct = 0
+      out_ct = 0
       for i in self.map_inputs():
+         in_ct += 1
          for kv in self.map(i):
-            self.map_write(*kv)
-      self.cleanup()
+            out_ct += 1
+            write(*kv)
+      for kv in self.map_finish():
+         out_ct += 1
+         write(*kv)
+      if (part_ct is None):
+         self.cleanup()
+      else:
+         for fp in self.outfps:
+            fp.close()
+      if (metrics is not None):
+         tm.stop(records_in=in_ct, records_out=out_ct)
+         tm.data.update(self.map_metrics())
+         tm.dump(metrics)
       #p.stop('map.prof')
 
    def map_write(self, key, value):
@@ -144,6 +265,35 @@ class Job(object, metaclass=ABCMeta):
       self.outfp.write(encode(value))
       self.outfp.write(b'\n')
 
+   def map_write_split(self, key, value):
+      '''Write one key/value pair to the output file for its partition.'''
+      self.outfp = self.outfps[self.partition_of(key)]
+      self.map_write(key, value)
+
+   def partition_of(self, key):
+      '''Return the partition of key; this matches hashsplit exactly, which
+         hashes the key bytes as written. Bytes keys are hashed unchanged, and
+         str keys as UTF-8. E.g.:
+
+         >>> j = Test_Job()
+         >>> j.partition_table = partition.Table.trivial(240)
+         >>> j.partition_cache = dict()
+         >>> [j.partition_of(k) for k in ('b', 'nullvaluenotab', 'b')]
+         [37, 145, 37]
+         >>> [j.partition_of(k) for k in (b't@ b', 't@ b', 't@ café',
+         ...                              b't@ caf\\xc3\\xa9')]
+         [187, 187, 239, 239]'''
+      if (not isinstance(key, bytes)):
+         key = str(key).encode('utf8')
+      try:
+         return self.partition_cache[key]
+      except KeyError:
+         if (len(self.partition_cache) >= PARTITION_CACHE_MAX):
+            self.partition_cache.clear()
+         p = self.partition_table.of(key)
+         self.partition_cache[key] = p
+         return p
+
    @abstractmethod
    def reduce(self, key, values):
       '''Generator which yields zero or more reduced items based upon the key
@@ -175,19 +325,74 @@ class Job(object, metaclass=ABCMeta):
       self.outfp = io.open(self.reduce_output_filename, 'wt',
                            encoding='utf8', buffering=OUTPUT_BUFSIZE)
 
-   def reduce_stdinout(self, rid):
-      '''Connect myself to input and output, and run my reducer.'''
+   def reduce_stdinout(self, rid, metrics=None, merge=False):
+      '''Connect myself to input and output, and run my reducer. If metrics is
+         given, write task metrics to that file (see :class:`Task_Metrics`).
+         If merge is true, the input is only the new part of the map output,
+         and the result is merged into the existing reduce output (see
+         :attr:`associative`).'''
       #p = u.Profiler()
+      tm = Task_Metrics('reduce', rid)
       self.rid = rid
+      if (merge):
+         old_items = self.reduce_old_items()
       self.reduce_open_input()
       self.reduce_open_output()
       self.reduce_init()
-      for kvals in self.reduce_inputs():
-         for item in self.reduce(*kvals):
-            self.reduce_write(item)
+      # Count input lines without a Python-level step per line: zip() and
+      # map() run in C, and the counter's next value is the number consumed.
+      line_ct = itertools.count()
+      self.infp = map(operator.itemgetter(0), zip(self.infp, line_ct))
+      self.key_ct = 0
+      items = self.reduce_items()
+      if (merge):
+         items = self.merge_items(old_items, items)
+      out_ct = 0
+      for item in items:
+         out_ct += 1
+         self.reduce_write(item)
       self.cleanup()
+      if (merge):
+         old = self.reduce_output_filename + '.old'
+         if (os.path.isdir(old)):
+            shutil.rmtree(old)  # some jobs write a directory
+         else:
+            os.unlink(old)
+      if (metrics is not None):
+         tm.stop(records_in=next(line_ct), records_out=out_ct, keys=self.key_ct)
+         tm.dump(metrics)
       #p.stop('reduce.prof')
 
+   def reduce_items(self):
+      '''Generator which runs :meth:`reduce()` over the whole reduce input and
+         yields the resulting items, counting keys in :attr:`key_ct`.'''
+      for kvals in self.reduce_inputs():
+         self.key_ct += 1
+         yield from self.reduce(*kvals)
+
+   def reduce_item_key(self, item):
+      '''Return the key of reduce output item. Needed only if
+         :attr:`associative`; typically implemented by an output mixin.'''
+      assert False, 'unimplemented'
+
+   def reduce_old_items(self):
+      '''Move the existing reduce output aside and return a generator of the
+         items in it. If a previous merge died after moving the output but
+         before finishing, the moved file is still the good one, so use it.'''
+      old = self.reduce_output_filename + '.old'
+      if (not os.path.exists(old)):
+         try:
+            os.rename(self.reduce_output_filename, old)
+         except FileNotFoundError:
+            return iter(())
+      return self.reduce_read_output(old)
+
+   def reduce_read_output(self, filename):
+      '''Generator which yields the items in reduce output file filename, in
+         order. Needed only if :attr:`associative`; typically implemented by
+         an output mixin.'''
+      assert False, 'unimplemented'
+
    @abstractmethod
    def reduce_write(self, item):
       '''Write one Python object, ``item``, to the reduce output stream (the
@@ -196,6 +401,57 @@ class Job(object, metaclass=ABCMeta):
       pass
 
 
+class Task_Metrics(object):
+
+   '''Counts and resource use of one map or reduce task, for ``quacreduce
+      --report``. Create the object when the task starts, call :meth:`stop()`
+      when it is done, and then :meth:`dump()` to write a small JSON file.
+
+      Byte counts come from the operating system's per-process I/O counters,
+      so they cost nothing per record; they include everything the process
+      reads or writes after the object is created (e.g., a mapper that opens
+      its own input files) and are None if not available. Peak RSS is for the
+      whole process lifetime. For example:
+
+      >>> tm = Task_Metrics('reduce', 3)
+      >>> tm.stop(records_in=10, records_out=2, keys=2)
+      >>> sorted(tm.data.keys())
+      ['bytes_in', 'bytes_out', 'cpu', 'host', 'id', 'keys', 'peak_rss', 'phase', 'records_in', 'records_out', 'wall']
+      >>> (tm.data['phase'], tm.data['id'], tm.data['records_in'])
+      ('reduce', 3, 10)
+      >>> tm.data['wall'] >= 0 and tm.data['peak_rss'] > 0
+      True'''
+
+   def __init__(self, phase, id_=None):
+      self.data = { 'phase': phase,
+                    'id': id_,
+                    'host': platform.node() }
+      self.wall_start = time.time()
+      self.ru_start = resource.getrusage(resource.RUSAGE_SELF)
+      self.io_start = io_counters()
+
+   def dump(self, filename):
+      with open(filename, 'w') as fp:
+         json.dump(self.data, fp, sort_keys=True)
+
+   def stop(self, records_in, records_out, keys=None):
+      ru = resource.getrusage(resource.RUSAGE_SELF)
+      io_end = io_counters()
+      self.data.update({
+         'records_in': records_in,
+         'records_out': records_out,
+         'keys': keys,
+         'wall': time.time() - self.wall_start,
+         'cpu': (  ru.ru_utime - self.ru_start.ru_utime
+                 + ru.ru_stime - self.ru_start.ru_stime),
+         'peak_rss': ru.ru_maxrss * 1024,  # Linux reports KiB
+         'bytes_in': None,
+         'bytes_out': None })
+      if (io_end[0] is not None and self.io_start[0] is not None):
+         self.data['bytes_in'] = io_end[0] - self.io_start[0]
+         self.data['bytes_out'] = io_end[1] - self.io_start[1]
+
+
 class Line_Input_Job(Job):
 
    '''Mixin for line-oriented Unicode plain text map input;
@@ -212,6 +468,10 @@ class Line_Output_Job(Job):
    def reduce_open_output(self):
       self.reduce_open_output_utf8()
 
+   def reduce_read_output(self, filename):
+      for line in io.open(filename, 'rt', encoding='utf8'):
+         yield line[:-1]
+
    def reduce_write(self, item):
       'Items to be unicode objects with no trailing newline.'
       assert (isinstance(item, str))
@@ -244,12 +504,20 @@ class KV_Pickle_Seq_Output_Job(Job):
       must yield (key, value) tuples. See :class:`KV_Pickle_Seq_Input_Job` for
       the output stream format.'''
 
+   def reduce_item_key(self, item):
+      return str(item[0])
+
+   def reduce_read_output(self, filename):
+      for l in io.open(filename, 'rb'):
+         (key, _, value) = l.partition(b'\t')
+         yield (key.decode('utf8'), decode(value))
+
    def reduce_write(self, item):
       assert (len(item) == 2)
       self.outfp.write(str(item[0]).encode('utf8'))
-      self.outfp.write('\t')
+      self.outfp.write(b'\t')
       self.outfp.write(encode(item[1]))
-      self.outfp.write('\n')
+      self.outfp.write(b'\n')
 
 
 class Test_Job(Job):
@@ -274,23 +542,28 @@ class TSV_Internal_Job(Job):
 
    '''Values transferred from mappers to reducers are iterables. They are
       "encoded" by simple tab separation. No checks for internal tabs or
-      newlines are performed, and anything that is not a string object needs
-      to be manually dealt with (keys are still Unicode).'''
+      newlines are performed, and anything that is not a string or bytes
+      object needs to be manually dealt with (keys are still Unicode in the
+      reducer, but values arrive as bytes).'''
 
    def map_write(self, key, value):
+      if (isinstance(key, str)):
+         key = key.encode('utf8')
       self.outfp.write(key)
       for v in value:
-         self.outfp.write('\t')
-         self.outfp.write(v)
-      self.outfp.write('\n')
+         self.outfp.write(b'\t')
+         self.outfp.write(v.encode('utf8') if isinstance(v, str) else v)
+      self.outfp.write(b'\n')
 
    def reduce_inputs(self):
-      for (key, values) in itertools.groupby((l.split('\t') for l in self.infp),
+      for (key, values) in itertools.groupby((l[:-1].split(b'\t')
+                                              for l in self.infp),
                                              key=operator.itemgetter(0)):
          try:
             key = key.decode('utf8')
             # Skip first item in each iterator within values (it's the key
-            # again). We use a generator and islice() to remain lazy.
+            # again). We use a generator and islice() to remain lazy. Values
+            # are left as bytes.
             values = (itertools.islice(i, 1, None) for i in values)
             yield (key, values)
          except UnicodeDecodeError:
@@ -327,4 +600,19 @@ b'1\tgASVBgAAAAAAAABK/////y4=\n2\tgASVBgAAAAAAAABK/v///y4=\n2\tgASVBgAAAAAAAABK/
 >>> [(k, list(v)) for (k, v) in job.reduce_inputs()]
 [('1', [-1]), ('2', [-2, -3]), ('3', [-4, -5, -6])]
 
+# Same, for tab-separated values.
+>>> class TSV_Test_Job(TSV_Internal_Job, Test_Job): pass
+>>> buf = io.BytesIO()
+>>> job = TSV_Test_Job()
+>>> job.outfp = buf
+>>> for kv in [('a', ('1', '2')), (b'b', (b'3', '4')), ('b', ('5', '6'))]:
+...    job.map_write(*kv)
+>>> buf.getvalue()
+b'a\t1\t2\nb\t3\t4\nb\t5\t6\n'
+>>> buf.seek(0)
+0
+>>> job.infp = buf
+>>> [(k, [list(i) for i in v]) for (k, v) in job.reduce_inputs()]
+[('a', [[b'1', b'2']]), ('b', [[b'3', b'4'], [b'5', b'6']])]
+
 ''')
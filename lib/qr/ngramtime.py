@@ -23,10 +23,10 @@
    an int, and we do it once per input line).'''
 
 
-import collections
 import datetime
 import glob
 import gzip
+import heapq
 import itertools
 import operator
 import sys
@@ -36,6 +36,7 @@ import numpy as np
 np.seterr(invalid='ignore')
 
 from . import base
+import csr_glue
 import math_
 import ssheet
 import tok.unicode_props
@@ -47,33 +48,100 @@ import wikimedia
 
 class Build_Job(base.TSV_Internal_Job, base.KV_Pickle_Seq_Output_Job):
 
+   '''If params['csr'] is true, each reducer writes its output as a sparse
+      series store (see csr_glue) rather than a sequence of pickles.'''
+
+   @property
+   def associative(self):
+      # N-grams dropped for falling below min_occur are gone for good, so
+      # their counts can't be merged with new ones later.
+      return (self.params['min_occur'] <= 1)
+
+   def cleanup(self):
+      if (self.rid is not None and self.params.get('csr')):
+         self.outfp.close()
+      else:
+         base.KV_Pickle_Seq_Output_Job.cleanup(self)
+
+   def merge(self, ngram, old, new):
+      (old_series, new_series) = math_.Date_Vector.bi_union(old[1]['series'],
+                                                             new[1]['series'])
+      return (ngram, { 'ngram': ngram,
+                       'total': old[1]['total'] + new[1]['total'],
+                       'series': old_series + new_series })
+
    def reduce(self, ngram, datecounts):
-      cts = collections.Counter()
-      first_day = float('+inf')
-      last_day = float('-inf')
-      for (date, count) in datecounts:
-         date = int(date)
-         count = int(count)
-         first_day = min(first_day, date)
-         last_day = max(last_day, date)
-         cts[date] += count
-      total = sum(cts.values())
-      if (total >= self.params['min_occur']):
-         assert (first_day <= last_day)
-         # use float32 for space efficiency at the expense of precision
-         first_dt = datetime.date.fromordinal(first_day)
-         last_dt = datetime.date.fromordinal(last_day)
-         ct_series = math_.Date_Vector.zeros(first_dt, last_dt,
-                                             dtype=np.float32)
-         for (date, ct) in cts.items():
-            ct_series[date - first_day] = ct
-         yield (ngram, { 'ngram': ngram,
-                         'total': total,
-                         'series': ct_series })
+      fields = list(itertools.chain.from_iterable(datecounts))
+      counts = list(map(int, fields[1::2]))
+      total = sum(counts)
+      # Most n-grams are rare, so drop them before allocating anything.
+      if (total < self.params['min_occur']):
+         return
+      dates = list(map(int, fields[0::2]))
+      first_day = min(dates)
+      # Build the series in one shot. If every count is 1 (always the case
+      # for tweets), the weights are unnecessary.
+      offsets = np.subtract(dates, first_day)
+      if (counts.count(1) == len(counts)):
+         ct_series = np.bincount(offsets)
+      else:
+         ct_series = np.bincount(offsets, weights=counts)
+      # use float32 for space efficiency at the expense of precision
+      ct_series = math_.Date_Vector(datetime.date.fromordinal(first_day),
+                                    ct_series.astype(np.float32))
+      yield (ngram, { 'ngram': ngram,
+                      'total': total,
+                      'series': ct_series })
+
+   def reduce_open_output(self):
+      if (self.params.get('csr')):
+         self.outfp = csr_glue.Writer(self.reduce_output_filename)
+      else:
+         base.KV_Pickle_Seq_Output_Job.reduce_open_output(self)
+
+   def reduce_read_output(self, filename):
+      if (self.params.get('csr')):
+         for (ngram, total, series) in csr_glue.Reader(filename):
+            yield (ngram, { 'ngram': ngram,
+                            'total': total,
+                            'series': series })
+      else:
+         yield from base.KV_Pickle_Seq_Output_Job.reduce_read_output(self,
+                                                                   filename)
+
+   def reduce_write(self, item):
+      if (self.params.get('csr')):
+         self.outfp.write(item[0], item[1]['total'], item[1]['series'])
+      else:
+         base.KV_Pickle_Seq_Output_Job.reduce_write(self, item)
 
 
 class Correlate_Job(base.KV_Pickle_Seq_Input_Job, base.TSV_Output_Job):
 
+   '''Correlate each n-gram with each target series. If params['top_k'] is
+      non-zero, only the top_k n-grams (by absolute correlation) for each
+      target are output. In that case, each mapper keeps a bounded heap per
+      target and emits it only at the end, and the reducer merges these
+      into a global top-k, so the volume of intermediate data is
+      proportional to the number of targets rather than the vocabulary.'''
+
+   def map_finish(self):
+      for (name, heap) in self.tops.items():
+         for (_, ngram, r, peak, trough) in heap:
+            yield (name, (ngram, r, peak, trough))
+
+   def map_inputs(self):
+      if (not self.params.get('csr')):
+         yield from base.KV_Pickle_Seq_Input_Job.map_inputs(self)
+         return
+      # Input is the names of sparse series stores; stream each one.
+      for line in self.infp:
+         dirname = line.decode('utf8').rstrip('\n')
+         for (ngram, total, series) in csr_glue.Reader(dirname):
+            yield (ngram, { 'ngram': ngram,
+                            'total': total,
+                            'series': series })
+
    def map_init(self):
       pickle_ = u.pickle_load(self.params['total_file'])
       self.totals = pickle_['projects']
@@ -104,6 +172,10 @@ class Correlate_Job(base.KV_Pickle_Seq_Input_Job, base.TSV_Output_Job):
             self.targets.append({ 'name':   name,
                                   'series': series,
                                   'mask':   mask })
+      # Best matches so far for each target (top_k mode only). Each heap is
+      # a min-heap of (|r|, ngram, r, peak, trough), so the weakest match is
+      # the one to evict.
+      self.tops = { t['name']: list() for t in self.targets }
 
    def map(self, kv):
       (_, ngram) = kv
@@ -135,7 +207,10 @@ class Correlate_Job(base.KV_Pickle_Seq_Input_Job, base.TSV_Output_Job):
          # Compute correlation.
          r = math_.pearson(ng_vec, trg_vec, ng_mask, trg_mask)
          if (abs(r) >= self.params['min_similarity']):
-            yield (t['name'], (ngram['ngram'], r, peak, trough))
+            if (not self.params.get('top_k')):
+               yield (t['name'], (ngram['ngram'], r, peak, trough))
+            else:
+               self.top_push(t['name'], (ngram['ngram'], r, peak, trough))
 
    def reduce_open_output(self):
       # output is opened in reduce()
@@ -152,15 +227,37 @@ class Correlate_Job(base.KV_Pickle_Seq_Input_Job, base.TSV_Output_Job):
       self.outfp = tsv_glue.Writer('%s/%s.tsv' % (self.outdir,
                                                   target_series_name),
                                    clobber=True, buffering=base.OUTPUT_BUFSIZE)
-      for m in sorted(matches, key=abs1, reverse=True):
-         yield m
+      if (not self.params.get('top_k')):
+         for m in sorted(matches, key=abs1, reverse=True):
+            yield m
+      else:
+         # Mappers each sent their own top k; merge these into the global
+         # top k without holding all of them.
+         for m in heapq.nlargest(self.params['top_k'], matches, key=abs1):
+            yield m
+
+   def top_push(self, target_name, match):
+      '''Add match to the top-k heap for target_name, evicting the weakest
+         match if the heap is full.'''
+      heap = self.tops[target_name]
+      item = (abs(match[1]), match[0]) + tuple(match[1:])
+      if (len(heap) < self.params['top_k']):
+         heapq.heappush(heap, item)
+      elif (item > heap[0]):
+         heapq.heapreplace(heap, item)
 
 
 class Tweet_Job(base.TSV_Input_Job, Build_Job):
 
+   '''If params['tzer_cache'] is non-zero, cache the tokenizations of that
+      many distinct tweet texts, so retweets and spam are tokenized once; the
+      cache statistics go in the map task metrics.'''
+
    def __init__(self, params):
       base.Job.__init__(self, params)
       self.tzer = tok.unicode_props.UP_Tiny(self.params['n'])
+      if (self.params.get('tzer_cache')):
+         self.tzer.cache_enable(self.params['tzer_cache'])
 
    def map(self, fields):
       # WARNING: make sure field indices match any file format changes
@@ -177,6 +274,11 @@ class Tweet_Job(base.TSV_Input_Job, Build_Job):
       for token in self.tzer.tokenize(fields[2]):  # tweet text
          yield (('t@ ' + token).encode('utf8'), (date, '1'))
 
+   def map_metrics(self):
+      if (self.tzer.cache is None):
+         return dict()
+      return { 'tzer_cache': self.tzer.cache_stats() }
+
 
 class Wikimedia_Job(Build_Job):
 
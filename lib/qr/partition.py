@@ -0,0 +1,223 @@
+'''Skew-aware partition tables. By default, QUACreduce assigns each key to
+   partition ``hash_.of(key) % N``. This is fine for uniform keys, but keys in
+   our data tend to be Zipfian (frequent n-grams, ``en+Main_Page``), so one
+   reducer gets far more than its share and the job waits on it.
+
+   A partition table fixes this using a sample of the map output keys:
+
+   * *Heavy* keys, those estimated to hold more data than an average hash
+     bucket, are assigned individually. (A key can't be split among
+     reducers, since all its values must be reduced together; a key heavier
+     than a partition's fair share simply ends up alone in its partition.)
+
+   * All other keys are hashed into many more buckets than there are
+     partitions, and the buckets are assigned to partitions according to
+     their estimated volume.
+
+   Assignment is greedy largest-first onto the least-loaded partition, which
+   is within 4/3 of optimal (for the estimated volumes).
+
+   The table is stored as a text file so that ``hashsplit`` can read it too
+   (make sure the two stay in sync):
+
+     line 1: ``qr-partition-table 1``
+     line 2: number of partitions, number of buckets, number of heavy keys
+     line 3: the partition of each bucket, separated by spaces
+     then one line per heavy key: its partition, a tab, and the key
+
+   Keys are bytes to hashsplit, and needn't be UTF-8; in Python, heavy keys
+   are str, with any bytes that aren't UTF-8 as surrogate escapes (see
+   :mod:`codecs`). The table file holds the original bytes.'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import collections
+import heapq
+import io
+
+import hash_
+import testable
+
+
+MAGIC = 'qr-partition-table 1'
+
+# Number of hash buckets per partition. More gives finer-grained balancing
+# but a larger table.
+BUCKETS_PER_PARTITION = 64
+
+# Maximum number of heavy keys.
+HEAVY_MAX = 4096
+
+
+class Table(object):
+
+   '''Map keys to partitions. For example, a table with three partitions, one
+      heavy key, and four buckets:
+
+      >>> t = Table(3, [1, 2, 1, 2], { 'a': 0 })
+      >>> t
+      Table(3, 4 buckets, 1 heavy keys)
+      >>> [t.of(k) for k in ('a', 'b', 'c')]
+      [0, 2, 1]
+
+      The trivial table is equivalent to partitioning by hash alone:
+
+      >>> t = Table.trivial(240)
+      >>> [t.of(k) for k in ('b', 'nullvaluenotab', '私の名前は中野です')]
+      [37, 145, 5]'''
+
+   __slots__ = ('part_ct', 'buckets', 'heavy')
+
+   def __init__(self, part_ct, buckets, heavy):
+      assert (all(0 <= p < part_ct for p in buckets))
+      assert (all(0 <= p < part_ct for p in heavy.values()))
+      self.part_ct = part_ct
+      self.buckets = buckets
+      self.heavy = heavy
+
+   def __repr__(self):
+      return ('Table(%d, %d buckets, %d heavy keys)'
+              % (self.part_ct, len(self.buckets), len(self.heavy)))
+
+   @classmethod
+   def build(class_, counts, part_ct, bucket_ct=None):
+      '''Return a table with part_ct partitions balanced for the key counts in
+         dict-like counts. E.g., one very heavy key gets its own partition,
+         and the rest are spread over the others:
+
+         >>> counts = { 'a': 100, 'b': 10, 'c': 10, 'd': 10, 'e': 10 }
+         >>> t = Table.build(counts, 3, bucket_ct=8)
+         >>> t
+         Table(3, 8 buckets, 1 heavy keys)
+         >>> sorted(t.loads(counts))
+         [20, 20, 100]
+         >>> len({ t.of(k) for k in 'bcde' } & { t.of('a') })
+         0
+
+         Compare plain hashing:
+
+         >>> sorted(Table.trivial(3).loads(counts))
+         [0, 20, 120]'''
+      if (bucket_ct is None):
+         bucket_ct = part_ct * BUCKETS_PER_PARTITION
+      total = sum(counts.values())
+      # Heavy keys. A key seen only once tells us nothing about its weight.
+      threshold = max(total / bucket_ct, 1)
+      heavy = dict()
+      for (key, ct) in collections.Counter(counts).most_common(HEAVY_MAX):
+         if (ct <= threshold):
+            break
+         heavy[key] = ct
+      # Bucket loads. Keys not in the sample also need a place; we estimate
+      # their volume as the number of keys seen once (Good-Turing) and spread
+      # it evenly over all buckets.
+      unseen = sum(1 for ct in counts.values() if ct == 1) / bucket_ct
+      bucket_loads = [unseen] * bucket_ct
+      for (key, ct) in counts.items():
+         if (key not in heavy):
+            bucket_loads[hash_.of(key) % bucket_ct] += ct
+      # Greedy assignment, heaviest first. Ties go to the partition with the
+      # fewest items.
+      items = ([(ct, 0, key) for (key, ct) in heavy.items()]
+               + [(ct, 1, i) for (i, ct) in enumerate(bucket_loads)])
+      items.sort(key=lambda x: x[0], reverse=True)
+      parts = [(0, 0, i) for i in range(part_ct)]
+      buckets = [None] * bucket_ct
+      for (ct, is_bucket, x) in items:
+         (load, item_ct, p) = heapq.heappop(parts)
+         if (is_bucket):
+            buckets[x] = p
+         else:
+            heavy[x] = p
+         heapq.heappush(parts, (load + ct, item_ct + 1, p))
+      return class_(part_ct, buckets, heavy)
+
+   @classmethod
+   def load(class_, filename):
+      '''Read a table from filename. E.g.:
+
+         >>> t = Table.load(io.StringIO('qr-partition-table 1\\n'
+         ...                             '3 4 1\\n'
+         ...                             '1 2 1 2\\n'
+         ...                             '0\\ta\\n'))
+         >>> t
+         Table(3, 4 buckets, 1 heavy keys)
+         >>> t.heavy
+         {'a': 0}
+         >>> Table.load(io.StringIO('foo\\n'))
+         Traceback (most recent call last):
+           ...
+         ValueError: not a partition table'''
+      fp = io.open(filename, 'rt', encoding='utf8', errors='surrogateescape',
+                   newline='\n') if isinstance(filename, str) else filename
+      if (fp.readline().rstrip('\n') != MAGIC):
+         raise ValueError('not a partition table')
+      (part_ct, bucket_ct, heavy_ct) = (int(i) for i in fp.readline().split())
+      buckets = [int(i) for i in fp.readline().split()]
+      heavy = dict()
+      for line in fp:
+         (p, _, key) = line.rstrip('\n').partition('\t')
+         heavy[key] = int(p)
+      if (len(buckets) != bucket_ct or len(heavy) != heavy_ct):
+         raise ValueError('truncated partition table')
+      return class_(part_ct, buckets, heavy)
+
+   @classmethod
+   def load_maybe(class_, filename, part_ct):
+      '''Read a table from filename if it exists, otherwise return the trivial
+         table with part_ct partitions. E.g.:
+
+         >>> Table.load_maybe('/does/not/exist', 2)
+         Table(2, 2 buckets, 0 heavy keys)'''
+      try:
+         return class_.load(filename)
+      except FileNotFoundError:
+         return class_.trivial(part_ct)
+
+   @classmethod
+   def trivial(class_, part_ct):
+      return class_(part_ct, list(range(part_ct)), dict())
+
+   def dump(self, filename):
+      '''Write the table to filename. E.g.:
+
+         >>> fp = io.StringIO()
+         >>> Table(3, [1, 2, 1, 2], { 'a': 0 }).dump(fp)
+         >>> fp.getvalue().split('\\n')
+         ['qr-partition-table 1', '3 4 1', '1 2 1 2', '0\\ta', '']'''
+      fp = io.open(filename, 'wt', encoding='utf8', errors='surrogateescape',
+                   newline='\n') if isinstance(filename, str) else filename
+      fp.write('%s\n' % (MAGIC))
+      fp.write('%d %d %d\n' % (self.part_ct, len(self.buckets),
+                               len(self.heavy)))
+      fp.write(' '.join(str(p) for p in self.buckets))
+      fp.write('\n')
+      for (key, p) in sorted(self.heavy.items()):
+         fp.write('%d\t%s\n' % (p, key))
+      if (isinstance(filename, str)):
+         fp.close()
+
+   def loads(self, counts):
+      'Return a list of the partition loads given key counts counts.'
+      loads = [0] * self.part_ct
+      for (key, ct) in counts.items():
+         loads[self.of(key)] += ct
+      return loads
+
+   def of(self, key):
+      '''Return the partition of key, which can be str or bytes. E.g.:
+
+         >>> t = Table(3, [1, 2, 1, 2], { 'é': 0, 'a\\udcffb': 0 })
+         >>> [t.of(k) for k in ('é', 'é'.encode('utf8'), b'a\\xffb',
+         ...                    b'\\xff', 'b', b'b')]
+         [0, 0, 0, 1, 2, 2]'''
+      if (not isinstance(key, str)):
+         key = key.decode('utf8', 'surrogateescape')
+      try:
+         return self.heavy[key]
+      except KeyError:
+         return self.buckets[hash_.of(key) % len(self.buckets)]
+
+
+testable.register('')
@@ -17,6 +17,23 @@ Notes:
 
   * If --reduce includes the string "%RID", it is replaced with the reducer
     ID; this is important for coordinating output files if --partitions > 1.
+    Similarly, "%(MID)" in --map is replaced with the mapper ID (the basename
+    of its input file).
+
+  * --skew-sample N first runs the mapper over the first N lines of each
+    input and builds a partition table (JOBDIR/out/partitions) from the keys
+    it emits, so that heavy keys and hash buckets are spread evenly over the
+    reducers instead of by hash alone. Use it if your keys are skewed. The
+    table is kept, so that readers of the output can find keys.
+
+  * --mapper-split makes Python mappers write their output directly to the
+    partition files, instead of piping it through hashsplit. This saves a
+    process and a copy of the map output per mapper; the partitions are
+    exactly the same.
+
+  * Python jobs write per-task metrics (record and byte counts, wall and CPU
+    time, peak RSS) to JOBDIR/tmp/*.json; "quacreduce --report" summarizes
+    them, including partition skew. Run it before "make clean".
 
   * --python is mutually exclusive with --map and --reduce (which must both be
     specified if one is).
@@ -41,9 +58,13 @@ Notes:
   * Beware shell quoting with --map and --reduce!
 '''
 
+import glob
+import json
 import os
+import statistics
 import subprocess as sp
 
+import testable
 import time_
 import u
 l = u.l
@@ -62,6 +83,8 @@ def parse_args(ap):
    # parse args
    args = u.parse_args(ap)
    # check arguments
+   if (len(args.inputs) == 0 and not getattr(args, 'report', False)):
+      ap.error('at least one input FILE is required')
    if (len(set(os.path.basename(i) for i in args.inputs)) != len(args.inputs)):
       ap.error('input file basenames must be unique')
    # absolutize input files
@@ -72,6 +95,33 @@ def parse_args(ap):
    # done
    return args
 
+def report(args):
+   '''Print a table of the task metrics in args.jobdir, followed by a
+      per-phase summary.'''
+   tasks = metrics_load(args.jobdir)
+   if (len(tasks) == 0):
+      u.abort('no task metrics found in %s/tmp' % (args.jobdir))
+   fmt = '%-6s %-20s %11s %11s %9s %10s %10s %8s %8s %10s'
+   print(fmt % ('phase', 'id', 'records_in', 'records_out', 'keys',
+                'bytes_in', 'bytes_out', 'wall', 'cpu', 'peak_rss'))
+   for t in tasks:
+      print(fmt % (t['phase'], t['id'], t['records_in'], t['records_out'],
+                   '-' if t['keys'] is None else t['keys'],
+                   fmt_bytes_maybe(t['bytes_in']),
+                   fmt_bytes_maybe(t['bytes_out']),
+                   '%.2f' % t['wall'], '%.2f' % t['cpu'],
+                   u.fmt_bytes(t['peak_rss'])))
+   for (phase, s) in sorted(metrics_summarize(tasks).items()):
+      print()
+      print('%s: %d tasks, %d records in, %d records out'
+            % (phase, s['tasks'], s['records_in'], s['records_out']))
+      print('  wall: min %.2fs, median %.2fs, max %.2fs (slowest: %s)'
+            % (s['wall_min'], s['wall_median'], s['wall_max'], s['slowest']))
+      print('  cpu: total %.2fs; peak RSS: max %s'
+            % (s['cpu'], u.fmt_bytes(s['peak_rss'])))
+      print('  skew (max/mean): records_in %.2f, wall %.2f'
+            % (s['skew_records'], s['skew_wall']))
+
 def run(args, job_ct):
    sp.check_call('cd %s && make -j%d' % (args.jobdir, job_ct), shell=True)
 
@@ -87,9 +137,14 @@ def setup(args):
    # problem, so assert instead of erroring.
    assert (len(args.inputs) > 0)
 
+   if (args.update):
+      update_check(args)
+   args.map_split = None
    directories_setup(args)
    if (args.python):
       pythonify(args)
+   if (args.mapper_split and not args.map_split):
+      u.abort('--mapper-split requires a Python mapper')
    makefile_dump(args)
    slurm_dump(args)
 
@@ -115,7 +170,7 @@ class ArgumentParser(u.ArgumentParser):
       gr = self.add_argument_group('job logistics')
       gr.add_argument('inputs',
                       metavar='FILE',
-                      nargs='+',
+                      nargs='*',
                       help='input files (must have unique names)')
       gr.add_argument('--dist',
                       action='store_true',
@@ -128,11 +183,18 @@ class ArgumentParser(u.ArgumentParser):
                       metavar='DIR',
                       default='.',
                       help='job directory (default .)')
+      gr.add_argument('--mapper-split',
+                      action='store_true',
+                      help='Python mappers write partitions without hashsplit')
       gr.add_argument('--partitions',
                       type=int,
                       metavar='N',
                       default=1,
                       help='number of partitions to use (default 1)')
+      gr.add_argument('--skew-sample',
+                      type=int,
+                      metavar='N',
+                      help='balance partitions using first N lines of each input')
       gr.add_argument('--sortdir',
                       metavar='DIR',
                       help='directory for sort temp files (default JOBDIR)')
@@ -142,7 +204,7 @@ class ArgumentParser(u.ArgumentParser):
                       help='sort memory to use (sort -S; default 64M)')
       gr.add_argument('--update',
                       action='store_true',
-                      help='add more input (not implemented; see issue #36)')
+                      help='rewrite the Makefile of an existing job in JOBDIR to add more input')
       return super(ArgumentParser, self).parse_args(args)
 
 
@@ -153,6 +215,9 @@ def directories_setup(args):
    u.mkdir_f('%s/out' % (args.jobdir))
    u.mkdir_f('%s/tmp' % (args.jobdir))
 
+def fmt_bytes_maybe(num):
+   return '-' if num is None else u.fmt_bytes(num)
+
 def makefile_dump(args):
    fp = open('%s/Makefile' % (args.jobdir), 'w')
    if (args.dist):
@@ -178,38 +243,128 @@ clean:
 reallyclean: clean
 	rm -Rf out/*
 ''')
+   # partition table
+   hashsplit = '%s/bin/hashsplit' % u.quacbase
+   if (args.skew_sample):
+      hashsplit += ' -t out/partitions'
+      table_dep = ' | out/partitions'
+      # The sample mapper's metrics aren't a real map task, so discard them.
+      fp.write('''
+out/partitions:
+\tfor i in %(inputs)s; do %(read_cmd)s $$i | head -n %(lines)d; done | %(map_cmd)s | %(bin)s/partition-table --notimes %(nparts)d $@.tmp && %(pipefail)s
+\trm -f tmp/_sample.map.json
+\tmv $@.tmp $@
+''' % { 'bin': '%s/bin' % u.quacbase,
+        'inputs': ' '.join(args.inputs),
+        'lines': args.skew_sample,
+        'map_cmd': args.map.replace('%(MID)', '_sample'),
+        'nparts': args.partitions,
+        'pipefail': PIPEFAIL,
+        'read_cmd': args.file_reader })
+   else:
+      table_dep = ''
    # mappers
    for filename in args.inputs:
+      ibase = os.path.basename(filename)
+      if (args.update):
+         # Remember that this input is being mapped again, since its old map
+         # output is already part of the reduce output and can't be merged.
+         remap = '[ ! -e tmp/%s.mapped ] || touch tmp/%s.remapped\n\t' % (ibase,
+                                                                        ibase)
+      else:
+         remap = ''
+      if (args.map_split):
+         map_cmd = args.map_split
+         split = ''
+      else:
+         map_cmd = args.map
+         split = ' | %s %d tmp/%s' % (hashsplit, args.partitions, ibase)
       fp.write('''
-%(mapdone)s: %(input)s
-	%(read_cmd)s %(input)s | %(map_cmd)s | %(hashsplit)s %(nparts)d tmp/%(ibase)s && %(pipefail)s
+%(mapdone)s: %(input)s%(table_dep)s
+	%(remap)s%(read_cmd)s %(input)s | %(map_cmd)s%(split)s && %(pipefail)s
 	touch %(mapdone)s
-''' % { 'ibase': os.path.basename(filename),
-        'input': filename,
-        'hashsplit': '%s/bin/hashsplit' % u.quacbase,
-        'map_cmd': args.map,
-        'mapdone': 'tmp/%s.mapped' % (os.path.basename(filename)),
-        'nparts': args.partitions,
+''' % { 'input': filename,
+        'map_cmd': map_cmd.replace('%(MID)', ibase),
+        'mapdone': 'tmp/%s.mapped' % (ibase),
         'pipefail': PIPEFAIL,
-        'read_cmd': args.file_reader })
+        'read_cmd': args.file_reader,
+        'remap': remap,
+        'split': split,
+        'table_dep': table_dep })
    # reducers
+   input_bases = [os.path.basename(i) for i in args.inputs]
    for rid in range(args.partitions):
-      input_bases = [os.path.basename(i) for i in args.inputs]
       cmd = args.reduce.replace('%(RID)', str(rid))
+      mapouts = ' '.join('tmp/%s/%d' % (i, rid) for i in input_bases)
+      if (not args.update):
+         cmd = cmd.replace('%(MERGE)', 'False')
+         reduce_cmd = ("LC_ALL=C sort -s -k1,1 -t'\t' -S %s -T %s %s | %s && %s"
+                       % (args.sortmem, args.sortdir, mapouts, cmd, PIPEFAIL))
+      else:
+         cmd = cmd.replace('%(MERGE)', "bool('$$merge')")
+         reduce_cmd = ("%s[ -z \"$$mapouts\" ] || { LC_ALL=C sort -s -k1,1 -t'\t' -S %s -T %s $$mapouts | %s && %s; }"
+                       % (update_prologue(rid, mapouts, args.merge),
+                          args.sortmem, args.sortdir, cmd, PIPEFAIL))
       fp.write('''
 %(reducedone)s: %(mapdones)s
-	LC_ALL=C sort -s -k1,1 -t'	' -S %(buf)s -T %(sortdir)s %(mapouts)s | %(cmd)s && %(pipefail)s
+	%(reduce_cmd)s
 	touch %(reducedone)s
-''' % { 'buf': args.sortmem,
-        'cmd': cmd,
-        'mapdones': ' '.join('tmp/%s.mapped' % (i) for i in input_bases),
-        'mapouts': ' '.join('tmp/%s/%d' % (i, rid) for i in input_bases),
-        'pipefail': PIPEFAIL,
-        'rid': rid,
-        'reducedone': 'tmp/%d.reduced' % (rid),
-        'sortdir': args.sortdir })
+''' % { 'mapdones': ' '.join('tmp/%s.mapped' % (i) for i in input_bases),
+        'reduce_cmd': reduce_cmd,
+        'reducedone': 'tmp/%d.reduced' % (rid) })
    fp.close()
 
+def metrics_load(jobdir):
+   '''Return a list of the task metrics dictionaries in jobdir, mappers first
+      (by input name) and then reducers (by partition).'''
+   tasks = list()
+   # Only the files the tasks write; e.g., an input x.json has hashsplit
+   # output directory tmp/x.json.
+   for phase in ('map', 'reduce'):
+      for filename in glob.glob('%s/tmp/*.%s.json' % (jobdir, phase)):
+         if (os.path.isfile(filename)):
+            with open(filename) as fp:
+               tasks.append(json.load(fp))
+   tasks.sort(key=lambda t: (t['phase'] != 'map', str(t['id']).zfill(12)))
+   return tasks
+
+def metrics_summarize(tasks):
+   '''Summarize a list of task metrics dictionaries by phase. Skew is the
+      maximum divided by the mean, i.e., how much longer the phase takes than
+      it would with perfect balance; for reducers, records_in skew is the
+      partition skew. For example:
+
+      >>> tasks = [{ 'phase': 'reduce', 'id': i, 'records_in': r,
+      ...            'records_out': 1, 'wall': w, 'cpu': w, 'peak_rss': 1 }
+      ...          for (i, r, w) in [(0, 10, 1.0), (1, 10, 1.0), (2, 40, 4.0)]]
+      >>> s = metrics_summarize(tasks)['reduce']
+      >>> (s['tasks'], s['records_in'], s['slowest'])
+      (3, 60, 2)
+      >>> (s['skew_records'], s['skew_wall'])
+      (2.0, 2.0)
+      >>> list(metrics_summarize(tasks).keys())
+      ['reduce']'''
+   summary = dict()
+   for phase in ('map', 'reduce'):
+      ts = [t for t in tasks if t['phase'] == phase]
+      if (len(ts) == 0):
+         continue
+      walls = [t['wall'] for t in ts]
+      records = [t['records_in'] for t in ts]
+      summary[phase] = {
+         'tasks': len(ts),
+         'records_in': sum(records),
+         'records_out': sum(t['records_out'] for t in ts),
+         'wall_min': min(walls),
+         'wall_median': statistics.median(walls),
+         'wall_max': max(walls),
+         'slowest': max(ts, key=lambda t: t['wall'])['id'],
+         'cpu': sum(t['cpu'] for t in ts),
+         'peak_rss': max(t['peak_rss'] for t in ts),
+         'skew_records': skew(records),
+         'skew_wall': skew(walls) }
+   return summary
+
 def pythonify(args):
    'Adjust args.map and args.reduce to call the appropriate Python methods.'
    assert (args.python)
@@ -219,10 +374,74 @@ def pythonify(args):
    # dictionary. See base.Job.__init__() for more on how this hack works.
    params = repr(u.str_to_dict(args.pyargs))
    base = "python3 -c \"import %(module)s; j = %(class_)s(%(params)s); " % locals()
+   # Ask the job itself whether it can merge new reduce output into old; this
+   # can depend on the parameters.
+   if (args.update):
+      job = u.class_by_name(args.python)(u.str_to_dict(args.pyargs))
+      args.merge = job.associative
+      if (not args.merge):
+         l.warning('--update: %s is not associative with these parameters,'
+                   ' so affected partitions will be reduced again from ALL map'
+                   ' output' % (args.python))
    if (args.map is None):
-      args.map = base + "j.map_stdinout()\""
+      args.map = base + "j.map_stdinout('tmp/%(MID).map.json', '%(MID)')\""
+      if (args.mapper_split):
+         # Mapper that writes partition files itself, in place of args.map |
+         # hashsplit. (args.map is still needed for --skew-sample.)
+         table = "'out/partitions'" if args.skew_sample else 'None'
+         args.map_split = (base + "j.map_stdinout('tmp/%%(MID).map.json', "
+                           "'%%(MID)', %d, 'tmp/%%(MID)', %s)\""
+                           % (args.partitions, table))
    if (args.reduce is None):
-      args.reduce = base + "j.reduce_stdinout(%(RID))\""
+      args.reduce = (base
+                     + "j.reduce_stdinout(%(RID), 'tmp/%(RID).reduce.json', %(MERGE))\"")
+
+def skew(xs):
+   'Return max(xs) / mean(xs), or 1.0 if the mean is zero.'
+   mean = sum(xs) / len(xs)
+   return (max(xs) / mean) if mean > 0 else 1.0
 
 def slurm_dump(args):
    pass  # unimplemented, see issue #33
+
+def update_check(args):
+   '''Abort unless args.jobdir contains an existing job that args can update.
+      Shell jobs are never merged, so set args.merge to False; pythonify()
+      overrides this for Python jobs.'''
+   if (not os.path.exists('%s/Makefile' % (args.jobdir))):
+      u.abort('--update: no existing job in %s' % (args.jobdir))
+   for d in glob.glob('%s/tmp/*/' % (args.jobdir)):
+      ct = len(os.listdir(d))
+      if (ct != args.partitions):
+         u.abort('--update: job has %d partitions, not %d' % (ct, args.partitions))
+      break
+   # The partition table must not change, or keys would be split.
+   table_old = 'out/partitions:' in open('%s/Makefile' % (args.jobdir)).read()
+   if (table_old != bool(args.skew_sample)):
+      u.abort('--update: --skew-sample must be given iff the job used it')
+   args.merge = False
+
+def update_prologue(rid, mapouts_all, merge):
+   '''Return shell code for an --update reducer recipe which sets $mapouts to
+      the map outputs that need reducing and $merge to non-empty if these
+      should be merged into the existing reduce output. If only new inputs
+      have been mapped since the last reduce, and the job can merge, then only
+      their (non-empty) map outputs are reduced; otherwise, everything is
+      reduced again from scratch. If no new input touches this partition,
+      $mapouts is empty and the reducer isn't run at all.'''
+   code = ('new=; full=; merge=; '
+           'for i in $(?:.mapped=); do '
+           '[ ! $$i.remapped -nt $@ ] || full=1; '
+           '[ ! -s $$i/%(rid)d ] || new="$$new $$i/%(rid)d"; '
+           'done; '
+           '[ -e $@ ] || full=1; '
+           'if [ -n "$$full" ]; then mapouts="%(all)s"; '
+           'elif [ -z "$$new" ]; then mapouts=; ')
+   if (merge):
+      code += 'else merge=1; mapouts="$$new"; fi; '
+   else:
+      code += 'else mapouts="%(all)s"; fi; '
+   return code % { 'rid': rid, 'all': mapouts_all }
+
+
+testable.register('')
@@ -8,9 +8,18 @@ from . import base
 
 class Job(base.Line_Input_Job, base.Line_Output_Job):
 
+   associative = True
+
    def map(self, line):
       for word in line.split():
          yield (word, None)
 
+   def merge(self, word, old, new):
+      return '%d %s' % (int(old.partition(' ')[0]) + int(new.partition(' ')[0]),
+                        word)
+
    def reduce(self, word, nones):
       yield '%d %s' % (len(list(nones)) * self.params['factor'], word)
+
+   def reduce_item_key(self, item):
+      return item.partition(' ')[2]
@@ -0,0 +1,348 @@
+'''Approximate similarity search over many time series.
+
+   Finding the series most correlated with a target normally means computing
+   the correlation with every series. An index instead keeps a short bit
+   signature of each series. The series is z-normalized, which makes Pearson
+   correlation equal to the cosine of the angle between two series. It is
+   optionally shortened by piecewise aggregate approximation (PAA), and then
+   projected onto random hyperplanes, keeping one bit per hyperplane for the
+   side it falls on (random-projection LSH, or SimHash). The fraction of bits
+   that differ between two signatures estimates the angle between the
+   series. Ranking signatures by Hamming distance to the query's signature,
+   or to its complement for negative correlation, gives a small candidate
+   set. Exact correlation is then computed for the candidates only.
+
+   All series in an index are aligned to a common window of periods. An
+   index is a directory containing:
+
+   * ``index.json``: parameters, including the source and window.
+   * ``names``: the series names, one per line.
+   * ``signatures.npy``: packed signature bits, one row per series.
+
+   Sources are a ``timeseries.Dataset`` or a directory of sparse ngrams-build
+   output (``ngrams-build --csr``).'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import datetime
+import glob
+import io
+import json
+import os.path
+
+import numpy as np
+import pandas as pd
+
+import csr_glue
+import db
+import math_
+import qr.partition
+import testable
+import timeseries
+import u
+
+
+MAGIC = 'quac-simindex 1'
+
+# Default signature length in bits.
+BITS_DEFAULT = 256
+
+# Number of series to handle at once.
+BLOCK_SIZE = 4096
+
+# Number of one bits in each byte value.
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+### Sources ###
+
+class Source(object):
+   '''A set of named time series aligned to window (a pandas PeriodIndex).
+      Iterating yields (name, values) pairs, where values is a float64
+      array over the window; fetch() yields the same for specific names.
+      desc is enough to open the source again with source_open().'''
+
+   def fetch(self, names):
+      assert False, 'unimplemented'
+
+
+class Dataset_Source(Source):
+
+   def __init__(self, path, interval, normalize):
+      self.desc = { 'kind': 'dataset',
+                    'path': os.path.abspath(path),
+                    'interval': interval,
+                    'normalize': normalize }
+      self.ds = timeseries.Dataset_Pandas(path)
+      self.ds.open_all()
+      self.window = pd.Series(0, index=self.ds.index).resample(interval,
+                                                               how='sum').index
+
+   def __iter__(self):
+      for s in self.ds.fetch_all(last_only=False,
+                                 normalize=self.desc['normalize'],
+                                 resample=self.desc['interval']):
+         yield (self.name_raw(s.name), s.values.astype(np.float64))
+
+   def fetch(self, names):
+      try:
+         df = self.ds.fetch_many(names, last_only=False,
+                                 normalize=self.desc['normalize'],
+                                 resample=self.desc['interval'])
+      except db.Not_Enough_Rows_Error:
+         return
+      for name in df.columns:
+         yield (self.name_raw(name), df[name].values.astype(np.float64))
+
+   def name_raw(self, name):
+      # Normalized series have a suffix; remove it so we can fetch by name.
+      if (self.desc['normalize']):
+         return name[:-len(timeseries.NZ_SUFFIX)]
+      return name
+
+
+class Ngram_Source(Source):
+
+   '''Sparse ngrams-build output. If the totals file is present, series are
+      normalized by the daily total of their project, as in Correlate_Job.
+      The window spans the first through last day with any data.'''
+
+   def __init__(self, path):
+      self.desc = { 'kind': 'ngrams', 'path': os.path.abspath(path) }
+      file_ct = u.glob_maxnumeric(path) + 1
+      self.readers = [csr_glue.Reader('%s/%d' % (path, i))
+                      for i in range(file_ct)]
+      self.table = qr.partition.Table.load_maybe(path + '/partitions',
+                                                 file_ct)
+      nonempty = [r for r in self.readers if r.nnz > 0]
+      self.first = min(int(r.days.min()) for r in nonempty)
+      last = max(int(r.days.max()) for r in nonempty)
+      self.window = pd.period_range(datetime.date.fromordinal(self.first),
+                                    periods=(last - self.first + 1), freq='D')
+      self.totals = dict()
+      try:
+         projects = u.pickle_load(path + '/total')['projects']
+      except IOError:
+         projects = dict()
+      for (proj, t) in projects.items():
+         self.totals[proj] = np.full(len(self.window), np.nan)
+         start = t['series'].first_day.toordinal() - self.first
+         for (i, v) in enumerate(t['series']):
+            if (0 <= start + i < len(self.window) and v > 0):
+               self.totals[proj][start + i] = v
+
+   def __iter__(self):
+      for r in self.readers:
+         for b in r.blocks():
+            for (i, key) in enumerate(b.keys):
+               (a, z) = (b.indptr[i], b.indptr[i+1])
+               yield (key, self.row(key, b.days[a:z], b.values[a:z]))
+
+   def fetch(self, names):
+      for name in names:
+         r = self.readers[self.table.of(name)]
+         i = r.find(name)
+         if (i is not None):
+            (a, z) = (r.indptr[i], r.indptr[i+1])
+            yield (name, self.row(name, r.days[a:z], r.values[a:z]))
+
+   def row(self, key, days, values):
+      x = np.zeros(len(self.window))
+      x[days - self.first] = values
+      proj = key.split(' ')[0]
+      if (proj in self.totals):
+         x /= self.totals[proj]
+      return x
+
+
+def source_open(path, interval='D', normalize=True):
+   '''Return the Source for path, either a timeseries.Dataset directory
+      (resampled to interval and optionally normalized) or sparse
+      ngrams-build output.'''
+   if (len(glob.glob(path + '/*.db')) > 0):
+      return Dataset_Source(path, interval, normalize)
+   elif (os.path.exists(path + '/0/csr')):
+      return Ngram_Source(path)
+   else:
+      raise ValueError('%s is neither a dataset nor sparse ngrams-build output'
+                       % (path))
+
+def source_reopen(desc):
+   if (desc['kind'] == 'dataset'):
+      return Dataset_Source(desc['path'], desc['interval'], desc['normalize'])
+   else:
+      return Ngram_Source(desc['path'])
+
+
+### Index ###
+
+class Index(object):
+
+   '''A similarity index (see above). E.g., index 200 random walks of 100
+      periods, and look for those closest to one of them and to its negation:
+
+      >>> import tempfile
+      >>> rs = np.random.RandomState(1)
+      >>> x = np.cumsum(rs.standard_normal((200, 100)), axis=1)
+      >>> names = ['s%d' % i for i in range(200)]
+      >>> d = tempfile.mkdtemp()
+      >>> Index.build(d, zip(names, x), { 'kind': 'test' }, '2015-01-01', 100,
+      ...             'D', paa=50)
+      Index(200 series, 256 bits, window 2015-01-01 + 100 D)
+      >>> idx = Index(d)
+      >>> idx.candidates(x[7], 3)[0]
+      's7'
+      >>> idx.candidates(-x[7], 3)[0]
+      's7'
+
+      Candidates should usually contain the true best matches:
+
+      >>> exact = top_exact(zip(names, x), x[42], 10)
+      >>> approx = top_exact(((n, x[int(n[1:])])
+      ...                     for n in idx.candidates(x[42], 40)), x[42], 10)
+      >>> recall(approx, exact) >= 0.8
+      True'''
+
+   __slots__ = ('dirname', 'params', 'names', 'signatures', 'planes')
+
+   def __init__(self, dirname):
+      self.dirname = dirname
+      with io.open(dirname + '/index.json', 'rt') as fp:
+         self.params = json.load(fp)
+      if (self.params.get('magic') != MAGIC):
+         raise ValueError('not a similarity index: %s' % (dirname))
+      with io.open(dirname + '/names', 'rt', encoding='utf8') as fp:
+         self.names = [line.rstrip('\n') for line in fp]
+      self.signatures = np.load(dirname + '/signatures.npy', mmap_mode='r')
+      self.planes = planes(self.params)
+
+   def __len__(self):
+      return len(self.names)
+
+   def __repr__(self):
+      return ('Index(%d series, %d bits, window %s + %d %s)'
+              % (len(self), self.params['bits'], self.params['start'],
+                 self.params['periods'], self.params['freq']))
+
+   @property
+   def window(self):
+      return pd.period_range(self.params['start'],
+                             periods=self.params['periods'],
+                             freq=self.params['freq'])
+
+   @classmethod
+   def build(class_, dirname, items, source_desc, start, periods, freq,
+             bits=BITS_DEFAULT, paa=None, seed=0):
+      '''Build an index in dirname of the (name, values) pairs in items, all
+         aligned to the window of periods periods of freq beginning at start.
+         Series with no variance can't correlate with anything, so they are
+         left out. Return the new index.'''
+      os.makedirs(dirname, exist_ok=True)
+      params = { 'magic': MAGIC,
+                 'source': source_desc,
+                 'start': str(start),
+                 'periods': periods,
+                 'freq': freq,
+                 'bits': bits,
+                 'paa': paa,
+                 'seed': seed }
+      planes_ = planes(params)
+      sigs = list()
+      with io.open(dirname + '/names', 'wt', encoding='utf8') as fp:
+         for block in u.groupn(items, BLOCK_SIZE):
+            x = np.vstack([v for (_, v) in block])
+            keep = np.nanstd(x, axis=1) > 0
+            for (i, (name, _)) in enumerate(block):
+               if (keep[i]):
+                  fp.write(name + '\n')
+            sigs.append(signature(x[keep], planes_, paa))
+      if (len(sigs) == 0):
+         sigs.append(np.zeros((0, (bits + 7) // 8), dtype=np.uint8))
+      np.save(dirname + '/signatures.npy', np.vstack(sigs))
+      with io.open(dirname + '/index.json', 'wt') as fp:
+         json.dump(params, fp, indent=2, sort_keys=True)
+      return class_(dirname)
+
+   def candidates(self, y, n):
+      '''Return the names of (up to) the n series whose signatures are
+         closest to that of y, which must be aligned to the window, or its
+         negation. NaNs in y are missing data.'''
+      q = signature(y, self.planes, self.params['paa'])[0]
+      bits = self.params['bits']
+      dists = list()
+      for start in range(0, len(self), BLOCK_SIZE * 16):
+         s = self.signatures[start:start + BLOCK_SIZE * 16]
+         d = POPCOUNT[s ^ q].sum(axis=1, dtype=np.int32)
+         dists.append(np.minimum(d, bits - d))
+      if (len(dists) == 0):
+         return []
+      dists = np.concatenate(dists)
+      n = min(n, len(dists))
+      best = np.argpartition(dists, n - 1)[:n]
+      best = best[np.argsort(dists[best], kind='stable')]
+      return [self.names[i] for i in best]
+
+
+### Functions ###
+
+def paa(x, segments):
+   '''Return the piecewise aggregate approximation of the rows of x, i.e.,
+      the mean of each of segments nearly equal pieces. E.g.:
+
+      >>> paa(np.array([[1, 2, 3, 4, 5, 6, 7]]), 3)
+      array([[1.5, 3.5, 6. ]])'''
+   edges = np.linspace(0, x.shape[1], segments + 1).astype(int)
+   return np.add.reduceat(x, edges[:-1], axis=1) / np.diff(edges)
+
+def planes(params):
+   'Return the random hyperplanes for an index with the given parameters.'
+   dims = params['paa'] or params['periods']
+   rs = np.random.RandomState(params['seed'])
+   return rs.standard_normal((dims, params['bits']))
+
+def recall(approx, exact):
+   '''Return the fraction of the (name, r) pairs in exact whose names also
+      appear in approx. E.g.:
+
+      >>> recall([('a', 1), ('c', 0.5)], [('a', 1), ('b', 0.7)])
+      0.5'''
+   if (len(exact) == 0):
+      return 1.0
+   return (len({ n for (n, _) in approx } & { n for (n, _) in exact })
+           / len(exact))
+
+def signature(x, planes_, paa_segments=None):
+   '''Return the packed signature bits of each row of x (or of x itself if
+      it's a vector).'''
+   x = znorm(np.array(x, dtype=np.float64, ndmin=2))
+   if (paa_segments):
+      x = paa(x, paa_segments)
+   return np.packbits(x.dot(planes_) > 0, axis=1)
+
+def top_exact(items, y, k):
+   '''Return the k (name, r) pairs in items with the greatest absolute Pearson
+      correlation with y, strongest first.'''
+   pq = u.Priority_Queue(k)
+   for block in u.groupn(items, BLOCK_SIZE):
+      r = math_.pearson_many(np.vstack([v for (_, v) in block]), y)
+      for i in np.argsort(-np.abs(r))[:k]:
+         pq.add(abs(r[i]), (block[i][0], float(r[i])))
+   return [v for (_, v) in sorted(pq.items(), key=lambda x: x[0],
+                                  reverse=True)]
+
+def znorm(x):
+   '''Return the rows of x z-normalized (zero mean, unit variance), with NaNs
+      and zero-variance rows replaced by zero. E.g.:
+
+      >>> znorm(np.array([[1, 2, np.nan, 3], [4, 4, 4, 4]]))
+      array([[-1.22474487,  0.        ,  0.        ,  1.22474487],
+             [ 0.        ,  0.        ,  0.        ,  0.        ]])'''
+   with np.errstate(divide='ignore', invalid='ignore'):
+      z = ((x - np.nanmean(x, axis=1, keepdims=True))
+           / np.nanstd(x, axis=1, keepdims=True))
+   z[~np.isfinite(z)] = 0
+   return z
+
+
+testable.register('')
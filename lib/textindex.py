@@ -0,0 +1,304 @@
+'''Inverted index of the tokens in one day's tweets, so that keyword queries
+   need not scan the whole .all.tsv.
+
+   For each token, the index stores a posting list: the ascending row
+   numbers of the tweets whose text contains it, as differences from the
+   previous row number, each in a variable-length little-endian base-128
+   encoding (7 bits per byte, high bit set on all but the last byte). Most
+   differences fit in one or two bytes. An index is a directory containing
+   the following files, all little-endian:
+
+   * ``keys.utf8``, ``keys.off``: The tokens, in ascending order (of their
+     UTF-8 encodings), concatenated, and n+1 int64 offsets into that.
+   * ``postings``: The posting lists, concatenated.
+   * ``indptr``: n+1 int64; the posting list of token i is at
+     ``indptr[i]:indptr[i+1]`` in ``postings``.
+   * ``counts``: int32; the number of rows containing each token.
+   * ``rows``: int64 byte offset in the .all.tsv of each row.
+   * ``index``: a magic line, the tokenizer, and the number of rows and of
+     tokens. This is written last, so an index without it is incomplete.'''
+
+# Copyright (c) Los Alamos National Security, LLC, and others.
+
+
+import array
+import io
+import mmap
+import os
+
+import numpy as np
+
+import testable
+import u
+
+
+MAGIC = 'quac-text-index 1'
+
+# Default tokenizer; must be a tok.base.Tzer subclass.
+TOKENIZER_DEFAULT = 'tok.unicode_props.UP_Tiny'
+
+
+class Reader(object):
+   '''Read an index. For example:
+
+      >>> import tempfile
+      >>> d = tempfile.mkdtemp()
+      >>> tsv = d + '/tweets.tsv'
+      >>> _ = open(tsv, 'w').write('1\\tx\\tFlu shot\\n'
+      ...                          '2\\tx\\tno flu, no FEVER\\n'
+      ...                          '3\\tx\\tfever\\n')
+      >>> build(tsv, d + '/idx', 'tok.base.Whitespace')
+      (3, 5)
+      >>> r = Reader(d + '/idx')
+      >>> (len(r), r.tzer)
+      (5, 'tok.base.Whitespace')
+      >>> r.postings('flu').tolist()
+      [0]
+      >>> r.postings('fever').tolist()
+      [1, 2]
+      >>> r.postings('cough').tolist()
+      []
+      >>> r.count('no')
+      1
+      >>> r.rows.tolist()
+      [0, 13, 34]
+      >>> r.line(open(tsv, 'rb').read(), 1).split(b'\\t')
+      [b'2', b'x', b'no flu, no FEVER\\n']'''
+
+   __slots__ = ('dirname', 'tzer', 'row_ct', 'count_', 'key_offsets',
+                'key_data', 'indptr', 'postings_data', 'counts', 'rows')
+
+   def __init__(self, dirname):
+      self.dirname = dirname
+      with io.open(dirname + '/index', 'rt') as fp:
+         if (fp.readline().rstrip('\n') != MAGIC):
+            raise ValueError('not a text index: %s' % (dirname))
+         self.tzer = fp.readline().rstrip('\n')
+         (self.row_ct, self.count_) = (int(i) for i in fp.readline().split())
+      self.key_offsets = self.memmap('keys.off', '<i8')
+      self.key_data = self.mmap_bytes('keys.utf8')
+      self.indptr = self.memmap('indptr', '<i8')
+      self.postings_data = self.memmap('postings', np.uint8)
+      self.counts = self.memmap('counts', '<i4')
+      self.rows = self.memmap('rows', '<i8')
+
+   def __len__(self):
+      return self.count_
+
+   def count(self, token):
+      'Return the number of rows containing token.'
+      i = self.find(token)
+      return 0 if i is None else int(self.counts[i])
+
+   def find(self, token):
+      '''Return the index of token, or None if it's not present. This is a
+         binary search, so it reads only a few pages of the index.'''
+      key = token.encode('utf8')
+      (lo, hi) = (0, self.count_)
+      while (lo < hi):
+         mid = (lo + hi) // 2
+         k = self.key_data[self.key_offsets[mid]:self.key_offsets[mid+1]]
+         if (k < key):
+            lo = mid + 1
+         elif (k > key):
+            hi = mid
+         else:
+            return mid
+      return None
+
+   def line(self, buf, row):
+      '''Return row of the indexed TSV file, given its contents buf (e.g.,
+         memory-mapped), including the trailing newline.'''
+      start = int(self.rows[row])
+      return buf[start:buf.find(b'\n', start) + 1]
+
+   def memmap(self, filename, dtype):
+      # See csr_glue.Reader.memmap().
+      return np.frombuffer(self.mmap_bytes(filename), dtype=dtype)
+
+   def mmap_bytes(self, filename):
+      with io.open('%s/%s' % (self.dirname, filename), 'rb') as fp:
+         if (os.fstat(fp.fileno()).st_size == 0):
+            return b''
+         return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+   def postings(self, token):
+      'Return the ascending row numbers of the rows containing token.'
+      i = self.find(token)
+      if (i is None):
+         return np.zeros(0, dtype=np.int64)
+      (a, b) = (int(self.indptr[i]), int(self.indptr[i+1]))
+      return np.cumsum(varint_decode(self.postings_data[a:b]))
+
+
+def build(tsv_name, dirname, tzer_name=TOKENIZER_DEFAULT, field=2):
+   '''Build an index in dirname (which is created if needed) of column field
+      (0-based; default the tweet text) of TSV file tsv_name, using the
+      tokenizer class named tzer_name. Return the number of rows and of
+      distinct tokens.'''
+   os.makedirs(dirname, exist_ok=True)
+   try:
+      os.unlink(dirname + '/index')  # no longer complete
+   except FileNotFoundError:
+      pass
+   tzer = u.class_by_name(tzer_name)(1)
+   # We accumulate (token ID, row number) pairs as one int64 each, with the
+   # token ID in the high bits, so one sort groups them by token and orders
+   # each group by row. Arrays rather than lists save a lot of memory.
+   token_ids = dict()
+   pairs = array.array('q')
+   rows = array.array('q')
+   offset = 0
+   with io.open(tsv_name, 'rb') as fp:
+      for line in fp:
+         row = len(rows)
+         rows.append(offset)
+         offset += len(line)
+         text = line.rstrip(b'\n').split(b'\t')[field].decode('utf8')
+         for t in set(tzer.tokenize(text)):
+            pairs.append((token_ids.setdefault(t, len(token_ids)) << 32) | row)
+   # Renumber tokens in key order, so the posting lists come out in that
+   # order too.
+   tokens = sorted(token_ids.keys(), key=lambda t: t.encode('utf8'))
+   order = np.empty(len(tokens), dtype=np.int64)
+   order[[token_ids[t] for t in tokens]] = np.arange(len(tokens))
+   pairs = np.frombuffer(pairs, dtype=np.int64)
+   pairs = np.sort((order[pairs >> 32] << 32) | (pairs & 0xffffffff))
+   tids = pairs >> 32
+   row_nos = pairs & 0xffffffff
+   # Posting lists as deltas from the previous row of the same token.
+   starts = np.flatnonzero(np.diff(tids, prepend=-1))
+   deltas = np.diff(row_nos, prepend=0)
+   deltas[starts] = row_nos[starts]
+   (data, ends) = varint_encode(deltas)
+   counts = np.diff(np.append(starts, len(tids)))
+   indptr = np.zeros(len(tokens) + 1, dtype=np.int64)
+   if (len(tokens) > 0):
+      indptr[1:] = ends[np.append(starts[1:], len(tids)) - 1]
+   keys = [t.encode('utf8') for t in tokens]
+   key_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+   key_offsets[1:] = np.cumsum([len(k) for k in keys])
+   def write(filename, a):
+      with io.open('%s/%s' % (dirname, filename), 'wb') as fp:
+         fp.write(a if isinstance(a, bytes) else a.tobytes())
+   write('keys.utf8', b''.join(keys))
+   write('keys.off', key_offsets.astype('<i8'))
+   write('postings', data)
+   write('indptr', indptr.astype('<i8'))
+   write('counts', counts.astype('<i4'))
+   write('rows', np.frombuffer(rows, dtype=np.int64).astype('<i8'))
+   with io.open(dirname + '/index', 'wt') as fp:
+      fp.write('%s\n%s\n%d %d\n' % (MAGIC, tzer_name, len(rows), len(tokens)))
+   return (len(rows), len(tokens))
+
+def query(reader, terms):
+   '''Return the ascending row numbers in Reader reader which match terms, a
+      sequence of terms as returned by query_parse(). Rare tokens are
+      intersected first, so the work is proportional to the smallest posting
+      lists. E.g.:
+
+      >>> import tempfile
+      >>> d = tempfile.mkdtemp()
+      >>> _ = open(d + '/t.tsv', 'w').write('1\\tx\\tFlu shot\\n'
+      ...                                   '2\\tx\\tno flu, no FEVER\\n'
+      ...                                   '3\\tx\\tfever\\n')
+      >>> _ = build(d + '/t.tsv', d + '/idx', 'tok.base.Whitespace')
+      >>> r = Reader(d + '/idx')
+      >>> query(r, [[['fever']]]).tolist()
+      [1, 2]
+      >>> query(r, [[['fever']], [['flu,'], ['shot']]]).tolist()
+      [1]
+      >>> query(r, [[['fever', 'no']]]).tolist()
+      [1]
+      >>> query(r, [[['flu'], ['fever']]]).tolist()
+      [0, 1, 2]
+      >>> query(r, [[['cough']], [['fever']]]).tolist()
+      []'''
+   def alt_rows(tokens):
+      tokens = sorted(tokens, key=reader.count)
+      rows = reader.postings(tokens[0])
+      for t in tokens[1:]:
+         if (len(rows) == 0):
+            break
+         rows = np.intersect1d(rows, reader.postings(t), assume_unique=True)
+      return rows
+   def term_rows(alts):
+      rows = np.zeros(0, dtype=np.int64)
+      for alt in alts:
+         rows = np.union1d(rows, alt_rows(alt))
+      return rows
+   # Estimate each term's size by its rarest tokens to order the terms.
+   terms = sorted(terms, key=lambda alts: sum(min(reader.count(t) for t in alt)
+                                             for alt in alts))
+   rows = term_rows(terms[0])
+   for alts in terms[1:]:
+      if (len(rows) == 0):
+         break
+      rows = np.intersect1d(rows, term_rows(alts), assume_unique=True)
+   return rows
+
+def query_parse(terms, tzer):
+   '''Parse terms, a sequence of strings, with tokenizer tzer. A row matches
+      if it matches every term. Each term is one or more alternatives
+      separated by "|", any of which may match. Each alternative is tokenized,
+      and all its tokens must match. Return a list with a list of
+      alternatives for each term, each of which is a list of tokens. Terms
+      or alternatives with no tokens are dropped. E.g.:
+
+      >>> import tok.unicode_props
+      >>> query_parse(['Flu|influenza', 'high fever', '!'],
+      ...             tok.unicode_props.UP_Tiny(1))
+      [[['flu'], ['influenza']], [['high', 'fever']]]'''
+   parsed = list()
+   for term in terms:
+      alts = [tzer.tokenize(alt) for alt in term.split('|')]
+      alts = [alt for alt in alts if len(alt) > 0]
+      if (len(alts) > 0):
+         parsed.append(alts)
+   return parsed
+
+def varint_decode(data):
+   '''Decode the concatenated varints in data (a uint8 array) and return them
+      as an int64 array. E.g.:
+
+      >>> varint_decode(np.array([5, 0x80, 1, 0xac, 0x02, 0],
+      ...                        dtype=np.uint8)).tolist()
+      [5, 128, 300, 0]'''
+   if (len(data) == 0):
+      return np.zeros(0, dtype=np.int64)
+   last = (data < 0x80)
+   ends = np.flatnonzero(last)
+   starts = np.append(0, ends[:-1] + 1)
+   # Position of each byte within its varint.
+   pos = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+   parts = (data & 0x7f).astype(np.int64) << (7 * pos)
+   return np.add.reduceat(parts, starts)
+
+def varint_encode(a):
+   '''Encode the non-negative integers in a as varints. Return a pair: the
+      encoding (bytes), and an array of the offset just past each value's
+      encoding. E.g.:
+
+      >>> (data, ends) = varint_encode(np.array([5, 128, 300, 0]))
+      >>> (list(data), ends.tolist())
+      ([5, 128, 1, 172, 2, 0], [1, 3, 5, 6])
+      >>> a = np.array([0, 1, 127, 128, 2**31, 2**40 + 3])
+      >>> varint_decode(np.frombuffer(varint_encode(a)[0], np.uint8)).tolist()
+      [0, 1, 127, 128, 2147483648, 1099511627779]'''
+   a = np.asarray(a, dtype=np.int64)
+   # Bytes needed per value: one per 7 bits, at least one.
+   sizes = np.ones(len(a), dtype=np.int64)
+   rest = a >> 7
+   while (rest.any()):
+      sizes += (rest > 0)
+      rest >>= 7
+   ends = np.cumsum(sizes)
+   starts = ends - sizes
+   pos = np.arange(ends[-1] if len(a) else 0) - np.repeat(starts, sizes)
+   vals = np.repeat(a, sizes) >> (7 * pos)
+   out = (vals & 0x7f).astype(np.uint8)
+   out[pos < np.repeat(sizes - 1, sizes)] |= 0x80
+   return (out.tobytes(), ends)
+
+
+testable.register('')
@@ -7,6 +7,7 @@
 
 
 from abc import ABCMeta, abstractmethod
+import functools
 import itertools
 import operator
 from pprint import pprint
@@ -19,27 +20,81 @@ class Tzer(object, metaclass=ABCMeta):
       if (ngram < 1):
          raise ValueError('ngram must be >= 1, but %d given' % (ngram))
       self.ngram = ngram
+      self.cache = None
+
+   def __getstate__(self):
+      # The cache can't be pickled (and shouldn't be shipped around anyway),
+      # so pickle its size only; the unpickled tokenizer starts out empty.
+      state = self.__dict__.copy()
+      if (self.cache is not None):
+         state['cache'] = self.cache.cache_info().maxsize
+      return state
+
+   def __setstate__(self, state):
+      size = state.pop('cache', None)
+      self.__dict__.update(state)
+      self.cache = None
+      if (size is not None):
+         self.cache_enable(size)
 
    def __str__(self):
       return '%s.%s;%d' % (self.__class__.__module__, self.__class__.__name__,
                            self.ngram)
 
+   def cache_enable(self, size):
+      '''Remember the tokenizations of the size most recently used distinct
+         strings, so that repeated texts (retweets, spam) are tokenized only
+         once. The key is the string itself; Python caches string hashes, so
+         lookup is cheap. Each tokenizer has its own cache, so the tokenizer
+         class and ngram are implicitly part of the key. Memory use is
+         bounded by size times the typical text and token list size, e.g.
+         roughly 1-2 KiB per entry for tweets with bigrams. Misses cost
+         extra, so this pays off only if a good fraction (a quarter or more)
+         of texts are repeats. For example:
+
+         >>> t = Whitespace(2)
+         >>> t.cache_stats() is None
+         True
+         >>> t.cache_enable(2)
+         >>> t.tokenize('a b')
+         ['a', 'b', 'a b']
+         >>> t.tokenize('a b')
+         ['a', 'b', 'a b']
+         >>> t.tokenize('c')
+         ['c']
+         >>> t.tokenize('d')
+         ['d']
+         >>> sorted(t.cache_stats().items())
+         [('entries', 2), ('hit_rate', 0.25), ('hits', 1), ('misses', 3), ('size', 2)]
+
+         Callers get their own copy of the token list, so modifying it does
+         not corrupt the cache:
+
+         >>> t.tokenize('d').append('x')
+         >>> t.tokenize('d')
+         ['d']'''
+      self.cache = functools.lru_cache(maxsize=size)(self.tokenize_str)
+
+   def cache_stats(self):
+      '''Return a dictionary of cache statistics (see :meth:`cache_enable`),
+         or None if the cache is disabled.'''
+      if (self.cache is None):
+         return None
+      ci = self.cache.cache_info()
+      return { 'hits': ci.hits,
+               'misses': ci.misses,
+               'entries': ci.currsize,
+               'size': ci.maxsize,
+               'hit_rate': ci.hits / max(1, ci.hits + ci.misses) }
+
    def tokenize(self, s):
       if (s is None):
          return []
       elif (isinstance(s, str)):
-         # The basic approach here:
-         # 1. Find the unigram sequence u and copy this to the output.
-         # 2. Bigrams: append itertools.izip(u, u[1:])
-         # 3. Trigrams: append itertools.izip(u, u[1:], u[2:])
-         # 4. etc.
-         unigrams = self.tokenize_real(s)
-         tokens = list(unigrams)
-         sources = [unigrams]
-         for i in range(1, self.ngram):
-            sources.append(unigrams[i:])
-            tokens += (' '.join(j) for j in zip(*sources))
-         return tokens
+         if (self.cache is None):
+            return self.tokenize_str(s)
+         else:
+            return list(self.cache(s))
       else:
          raise TypeError('expected unicode or None, got %s' % (type(s)))
 
@@ -62,6 +117,21 @@ class Tzer(object, metaclass=ABCMeta):
       '''Given a unicode s, tokenize it and return the tokenization as a
          sequence of tokens. s is guaranteed to be a unicode object.'''
 
+   def tokenize_str(self, s):
+      '''Tokenize str s, including n-grams, without the cache.'''
+      # The basic approach here:
+      # 1. Find the unigram sequence u and copy this to the output.
+      # 2. Bigrams: append itertools.izip(u, u[1:])
+      # 3. Trigrams: append itertools.izip(u, u[1:], u[2:])
+      # 4. etc.
+      unigrams = self.tokenize_real(s)
+      tokens = list(unigrams)
+      sources = [unigrams]
+      for i in range(1, self.ngram):
+         sources.append(unigrams[i:])
+         tokens += (' '.join(j) for j in zip(*sources))
+      return tokens
+
 
 class Whitespace(Tzer):
    'Just split on whitespace and squash case.'
@@ -112,6 +182,18 @@ Traceback (most recent call last):
    ...
 ValueError: ngram must be >= 1, but 0 given
 
+# The cache survives pickling, but empty
+>>> import pickle
+>>> t = Whitespace(1)
+>>> t.cache_enable(8)
+>>> t.tokenize('a b')
+['a', 'b']
+>>> t2 = pickle.loads(pickle.dumps(t))
+>>> t2.tokenize('a b')
+['a', 'b']
+>>> (t2.cache_stats()['misses'], t2.cache_stats()['size'])
+(1, 8)
+
 # Test ngrams
 >>> Whitespace(1).tokenize('a b c')
 ['a', 'b', 'c']
@@ -1,8 +1,5 @@
 # Copyright (c) Los Alamos National Security, LLC, and others.
 
-import itertools
-import operator
-
 import unicodedata2
 
 from . import base
@@ -60,12 +57,14 @@ class UP_Tiny(base.Tzer):
       self.tiny = tiny.Tzer(ngram)
 
    def tokenize_real(self, text):
-      chars = ((unicodedata2.script_cat(c), c) for c in text)
       tokens = list()
-      for (key, group) in itertools.groupby(chars, operator.itemgetter(0)):
-         if (key[1][0] == 'L' and key[0] not in self.DISCARD_SCRIPTS):
-            cand = ''.join((c[1] for c in group))
-            if (key[0] in self.JP_SCRIPTS):
+      end = 0
+      for ((script, cat), length) in unicodedata2.script_cat_runs(text):
+         start = end
+         end += length
+         if (cat[0] == 'L' and script not in self.DISCARD_SCRIPTS):
+            cand = text[start:end]
+            if (script in self.JP_SCRIPTS):
                tokens.extend(self.tiny.tokenize(cand))
             else:
                tokens.append(cand.lower())
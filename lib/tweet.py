@@ -4,13 +4,19 @@
 
 
 
+import collections
 from datetime import date, datetime
 import dateutil.parser
 import html.parser
+import io
+import mmap
+import os
 from pprint import pprint
 import re
 
 from django.contrib.gis import geos
+import numpy as np
+import pytz
 import ujson as json
 
 import testable
@@ -23,6 +29,36 @@ HTML_PARSER = html.parser.HTMLParser()
 NON_ALPHANUMERICS_RE = re.compile(r'[\W_]+')
 WHITESPACES_RE = re.compile(r'[\s\0]+')
 
+# Columnar tweet stores (see Column_Writer). Fixed-width columns are stored
+# as raw little-endian arrays, named for the column and dtype; text columns
+# as concatenated UTF-8 (.utf8) plus an array of n+1 offsets into it (.off).
+COLUMNS_MAGIC = 'quac-tweet-columns 1'
+COLUMNS_FIXED = (('id', '<i8'),
+                 ('created_at', '<i8'),  # seconds since the epoch (UTC)
+                 ('lon', '<f8'),         # 0 if no geotag
+                 ('lat', '<f8'))
+COLUMNS_TEXT = ('text',
+                'user_screen_name',
+                'user_description',
+                'user_lang',
+                'user_location',
+                'user_time_zone',
+                'geom_src')
+COLUMNS_FLUSH = 65536  # rows of fixed-width columns to buffer
+
+# Fields of the list (TSV) representation of a tweet, in order.
+ROW_FIELDS = ('id',
+              'created_at',
+              'text',
+              'user_screen_name',
+              'user_description',
+              'user_lang',
+              'user_location',
+              'user_time_zone',
+              'lon',
+              'lat',
+              'geom_src')
+
 
 class Nothing_To_Parse_Error(Exception):
    pass
@@ -32,6 +68,22 @@ class Unknown_Object_Error(Exception):
       return 'unknown object parsed'
 
 
+def coords_parse(lon, lat):
+   '''Given longitude and latitude, return them as a pair of floats, or
+      (None, None) if either is None or both are zero. lon and lat can be
+      strings, in which case they must be convertible to floats. E.g.:
+
+      >>> coords_parse('16.37778864', 48.24424304)
+      (16.37778864, 48.24424304)
+      >>> coords_parse(0, '0')
+      (None, None)'''
+   if (lon is None or lat is None):
+      return (None, None)
+   (lon, lat) = (float(lon), float(lat))
+   if (lon == lat == 0):
+      return (None, None)
+   return (lon, lat)
+
 def expected_count(date_, sample_rate):
    '''Return the expected number of tweets on date with sample_rate. This very
       gross number comes from piecewise linear fits in tweet-volume.xls. (You
@@ -126,6 +178,23 @@ def is_enough(date_, count, sample_rate=0.01):
    # If you change the factor, you may want to also update tweet-volume.xls.
    return (count >= expected_count(date_, sample_rate) * 0.5)
 
+def mmap_bytes(filename):
+   'Return the contents of filename, memory-mapped if possible.'
+   with io.open(filename, 'rb') as fp:
+      if (os.fstat(fp.fileno()).st_size == 0):
+         return b''
+      return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+def row_from_list(list_):
+   '''Given a list representation of a tweet (e.g., a TSV row), return the
+      corresponding Row. E.g.:
+
+      >>> r = row_from_list(['-1', '2012-04-01T06:31:18+00:00', 'a b', 'c',
+      ...                    'd', 'e', 'f', 'g', '16.5', '48.25', 'co'])
+      >>> (r.id, r.created_at, r.text, r.lon, r.lat, r.geom_src)
+      (-1, datetime.datetime(2012, 4, 1, 6, 31, 18, tzinfo=<UTC>), 'a b', 16.5, 48.25, 'co')'''
+   return Row._make(_fields_from_list(list_))
+
 def text_clean(t):
    '''We do three things to clean up text from the Twitter API:
 
@@ -158,6 +227,17 @@ def text_clean(t):
       t = WHITESPACES_RE.sub(' ', t)
       return t
 
+def _fields_from_list(list_):
+   '''Given a list representation of a tweet, return a tuple of its parsed
+      fields in ROW_FIELDS order. This is shared by row_from_list() and
+      Tweet.from_list(); the latter unpacks it straight into its slots,
+      since building a Row first costs a Python-level call per tweet.'''
+   # WARNING: Make sure this is consistent with Tweet.to_list() and README.
+   (lon, lat) = coords_parse(list_[8], list_[9])
+   return (int(list_[0]), time_.iso8601utc_parse(list_[1]), list_[2],
+           list_[3], list_[4], list_[5], list_[6], list_[7], lon, lat,
+           list_[10])
+
 
 class Ignored_Object(object):
 
@@ -173,11 +253,123 @@ class Status_Withheld(Ignored_Object): pass
 class Warning(Ignored_Object): pass
 
 
+class Column_Reader(object):
+
+   '''Like Reader, except it reads a columnar tweet store written by
+      Column_Writer. Only the Tweet attributes in fields (default all; "geom"
+      means lon and lat) are read; the others are None. Columns are
+      memory-mapped and nothing is parsed, so jobs which need only a few
+      fields (e.g., created_at and text) skip the cost of the rest entirely.
+      rows() yields Row tuples rather than Tweet objects, and column() gives
+      direct access for jobs that don't want either.'''
+
+   __slots__ = ('dirname', 'count', 'fields')
+
+   def __init__(self, dirname, fields=None):
+      self.dirname = dirname
+      with io.open(dirname + '/columns', 'rt') as fp:
+         if (fp.readline().rstrip('\n') != COLUMNS_MAGIC):
+            raise ValueError('not a tweet column store: %s' % (dirname))
+         self.count = int(fp.readline())
+      if (fields is None):
+         fields = ROW_FIELDS
+      elif ({ 'geom', 'lon', 'lat' } & set(fields)):
+         fields = list(fields) + ['lon', 'lat']
+      self.fields = [f for f in ROW_FIELDS if f in fields]
+
+   def __iter__(self):
+      for row in self.rows():
+         yield Tweet.from_row(row)
+
+   def __len__(self):
+      return self.count
+
+   def column(self, name):
+      '''Return column name: a read-only NumPy array for fixed-width columns
+         (e.g., created_at as epoch seconds) or a Text_Column.'''
+      path = '%s/%s' % (self.dirname, name)
+      fixed = dict(COLUMNS_FIXED)
+      if (name in fixed):
+         return self.memmap('%s.%s' % (path, fixed[name][1:]), fixed[name])
+      elif (name in COLUMNS_TEXT):
+         return Text_Column(self.memmap(path + '.off', '<i8'),
+                            mmap_bytes(path + '.utf8'))
+      else:
+         raise ValueError('unknown column: %s' % (name))
+
+   def memmap(self, filename, dtype):
+      if (os.path.getsize(filename) == 0):
+         return np.zeros(0, dtype=dtype)  # can't map an empty file
+      return np.memmap(filename, dtype=dtype, mode='r')
+
+   def rows(self):
+      '''Generator which yields a Row for each tweet, with fields not read
+         set to None.'''
+      cols = { f: self.column(f) for f in self.fields }
+      nones = [None] * COLUMNS_FLUSH
+      # Work in chunks, converting each column slice to a list at once;
+      # indexing NumPy arrays one element at a time is slow.
+      for start in range(0, self.count, COLUMNS_FLUSH):
+         end = min(start + COLUMNS_FLUSH, self.count)
+         chunk = { f: c[start:end].tolist() for (f, c) in cols.items() }
+         if ('created_at' in chunk):
+            chunk['created_at'] = [datetime.fromtimestamp(t, pytz.utc)
+                                   for t in chunk['created_at']]
+         if ('lon' in chunk):
+            # no geotag is stored as (0, 0)
+            for i in range(end - start):
+               if (chunk['lon'][i] == chunk['lat'][i] == 0):
+                  chunk['lon'][i] = chunk['lat'][i] = None
+         yield from map(Row, *(chunk.get(f, nones)[:end - start]
+                               for f in ROW_FIELDS))
+
+
 class Reader(tsv_glue.Reader):
    'Like a tsv_glue.Reader, except it emits Tweet objects, not lists.'
 
    def __next__(self):
-      return Tweet.from_list(tsv_glue.Reader.next(self))
+      return Tweet.from_list(tsv_glue.Reader.__next__(self))
+
+
+class Row(collections.namedtuple('Row', ROW_FIELDS)):
+   '''A tweet as a plain tuple of its fields, for bulk readers that don't
+      need Tweet objects. lon and lat are floats or None; use Tweet.from_row()
+      to get a Tweet.'''
+   __slots__ = ()
+
+
+class Row_Reader(tsv_glue.Reader):
+   'Like Reader, except it emits Row tuples.'
+
+   def __next__(self):
+      return row_from_list(tsv_glue.Reader.__next__(self))
+
+
+class Text_Column(object):
+   '''Read-only sequence of strings stored as UTF-8 bytes and offsets. Empty
+      strings are returned as None, as in the TSV files. Slicing (with
+      explicit start and stop) returns another Text_Column without copying,
+      and tolist() decodes all of them at once.'''
+
+   __slots__ = ('offsets', 'data')
+
+   def __init__(self, offsets, data):
+      self.offsets = offsets
+      self.data = data
+
+   def __getitem__(self, i):
+      if (isinstance(i, slice)):
+         return Text_Column(self.offsets[i.start:i.stop+1], self.data)
+      s = self.data[self.offsets[i]:self.offsets[i+1]]
+      return s.decode('utf8') if s else None
+
+   def __len__(self):
+      return len(self.offsets) - 1
+
+   def tolist(self):
+      offsets = self.offsets.tolist()
+      return [(self.data[a:b].decode('utf8') if a != b else None)
+              for (a, b) in zip(offsets, offsets[1:])]
 
 
 class Tweet(object):
@@ -185,28 +377,23 @@ class Tweet(object):
    # NOTE: Tweet geotags with coordinates (0, 0) cannot be stored, because
    # these coordinates are almost certainly bogus. So, if you encounter a
    # tweet which really does have these coordinates, you are out of luck.
+   #
+   # The geotag is stored as plain floats lon and lat; the GEOS point geom is
+   # created only when first asked for, since many jobs (e.g., n-gram
+   # counting) never look at it and creating it is expensive.
 
-   __slots__ = ('tokens',
-                'id',
-                'created_at',
-                'text',
-                'user_screen_name',
-                'user_description',
-                'user_lang',
-                'user_location',
-                'user_time_zone',
-                'geom',
-                'geom_src')
+   __slots__ = ('tokens', '_geom') + ROW_FIELDS
 
    def __init__(self):
       self.tokens = None
+      self._geom = None
 
    def __eq__(self, other):
       try:
          if (self.__slots__ != other.__slots__): return False
       except AttributeError:
          return False
-      for attr in self.__slots__:
+      for attr in ('tokens',) + ROW_FIELDS:
          if (getattr(self, attr) != getattr(other, attr)): return False
       return True
 
@@ -234,13 +421,26 @@ class Tweet(object):
       'String representation of the created_at day.'
       return self.created_at.strftime('%Y-%m-%d')
 
+   @property
+   def geom(self):
+      'The geotag as a geos.Point, or None. Created on first access.'
+      if (self._geom is None and self.lon is not None):
+         self._geom = geos.Point((self.lon, self.lat), srid=u.WGS84_SRID)
+      return self._geom
+
+   @geom.setter
+   def geom(self, point):
+      self._geom = point
+      if (point is None):
+         (self.lon, self.lat) = (None, None)
+      else:
+         (self.lon, self.lat) = point.coords
+
    @classmethod
    def from_json(class_, json):
       o = class_()
       # raw data
       o.id = json['id']
-        # FIXME: This time parse routine is fairly slow (about half of the
-        # total time is spent parsing dates).
       o.created_at = time_.twitter_timestamp_parse(json['created_at'])
       o.text = text_clean(json['text'])
       o.user_screen_name = text_clean(json['user']['screen_name'])
@@ -252,15 +452,15 @@ class Tweet(object):
       o.user_location = text_clean(json['user']['location'])
       o.user_time_zone = text_clean(json['user']['time_zone'])
       try:
-         o.geom = o.coords_to_point(json['coordinates']['coordinates'][0],
-                                    json['coordinates']['coordinates'][1])
+         coords = json['coordinates']['coordinates']
+         (o.lon, o.lat) = coords_parse(coords[0], coords[1])
          o.geom_src = 'co'
          assert (json['coordinates']['type'] == 'Point')
       except (TypeError, KeyError):
          # json['coordinates']:
          # - isn't a dict if there's no geotag (TypeError)
          # - may not exist at all in older tweets (KeyError)
-         o.geom = None
+         (o.lon, o.lat) = (None, None)
          o.geom_src = None
       return o
 
@@ -284,32 +484,34 @@ class Tweet(object):
    @classmethod
    def from_list(class_, list_):
       'Given a list representation, return the corresponding Tweet object.'
-      # WARNING: Make sure this is consistent with to_list() and README.
       o = class_()
-      o.id = int(list_[0])
-      o.created_at = time_.iso8601utc_parse(list_[1])  # FIXME: Slow? Issue #46
-      o.text = list_[2]
-      o.user_screen_name = list_[3]
-      o.user_description = list_[4]
-      o.user_lang = list_[5]
-      o.user_location = list_[6]
-      o.user_time_zone = list_[7]
-      o.geom = o.coords_to_point(list_[8], list_[9])
-      o.geom_src = list_[10]
+      (o.id, o.created_at, o.text, o.user_screen_name, o.user_description,
+       o.user_lang, o.user_location, o.user_time_zone, o.lon, o.lat,
+       o.geom_src) = _fields_from_list(list_)
+      return o
+
+   @classmethod
+   def from_row(class_, row):
+      'Given a Row, return the corresponding Tweet object.'
+      o = class_()
+      (o.id, o.created_at, o.text, o.user_screen_name, o.user_description,
+       o.user_lang, o.user_location, o.user_time_zone, o.lon, o.lat,
+       o.geom_src) = row
       return o
 
    def coords_to_point(self, lon, lat):
       '''Given longitude and latitude, return a geos.Point object, or None if
          the coordinates are None or zero. lon and lat can be strings or
          unicodes, in which case they must be convertible to floats.'''
-      if (lon is None or lat is None or (float(lon) == float(lat) == 0)):
+      (lon, lat) = coords_parse(lon, lat)
+      if (lon is None):
          return None
       else:
-         return geos.Point((float(lon), float(lat)), srid=u.WGS84_SRID)
+         return geos.Point((lon, lat), srid=u.WGS84_SRID)
 
    def geotagged_p(self):
       'Return true if this tweet is geotagged, false otherwise.'
-      return (self.geom is not None)
+      return (self.lon is not None)
 
    def to_dict(self):
       'Return a dictionary representation of this object.'
@@ -330,10 +532,6 @@ class Tweet(object):
       'Return a list representation of this object.'
       # WARNING: Make sure this is consistent with README and from_list()
       # FIXME: should this be a special method of some kind?
-      if (self.geom is None):
-         (lon, lat) = (None, None)
-      else:
-         (lon, lat) = self.geom.coords
       return [ self.id,
                self.created_at.isoformat(),
                self.text,
@@ -342,8 +540,8 @@ class Tweet(object):
                self.user_lang,
                self.user_location,
                self.user_time_zone,
-               lon,
-               lat,
+               self.lon,
+               self.lat,
                self.geom_src ]
 
    def tokenize(self, tker, fields, unify):
@@ -370,6 +568,58 @@ class Tweet(object):
       assert False, "unimplemented"
 
 
+class Column_Writer(object):
+   '''Write Tweet objects to a columnar store in directory dirname, which is
+      created if needed (existing content is overwritten). The store is
+      complete only after close(), which writes the row count.'''
+
+   __slots__ = ('dirname', 'count', 'fixed', 'fixed_bufs', 'texts',
+                'text_ends')
+
+   def __init__(self, dirname):
+      os.makedirs(dirname, exist_ok=True)
+      self.dirname = dirname
+      self.count = 0
+      def open_(name):
+         return io.open('%s/%s' % (dirname, name), 'wb')
+      self.fixed = { name: open_('%s.%s' % (name, dtype[1:]))
+                     for (name, dtype) in COLUMNS_FIXED }
+      self.fixed_bufs = { name: list() for (name, _) in COLUMNS_FIXED }
+      self.fixed_bufs.update({ name + '.off': [0] for name in COLUMNS_TEXT })
+      self.fixed.update({ name + '.off': open_(name + '.off')
+                          for name in COLUMNS_TEXT })
+      self.texts = { name: open_(name + '.utf8') for name in COLUMNS_TEXT }
+      self.text_ends = { name: 0 for name in COLUMNS_TEXT }
+
+   def close(self):
+      self.flush()
+      for fp in list(self.fixed.values()) + list(self.texts.values()):
+         fp.close()
+      with io.open(self.dirname + '/columns', 'wt') as fp:
+         fp.write('%s\n%d\n' % (COLUMNS_MAGIC, self.count))
+
+   def flush(self):
+      dtypes = dict(COLUMNS_FIXED)
+      for (name, buf) in self.fixed_bufs.items():
+         np.array(buf, dtype=dtypes.get(name, '<i8')).tofile(self.fixed[name])
+         buf.clear()
+
+   def writerow(self, tw):
+      b = self.fixed_bufs
+      b['id'].append(tw.id)
+      b['created_at'].append(int(tw.created_at.timestamp()))
+      b['lon'].append(tw.lon or 0)
+      b['lat'].append(tw.lat or 0)
+      for name in COLUMNS_TEXT:
+         text = getattr(tw, name)
+         if (text):
+            self.text_ends[name] += self.texts[name].write(text.encode('utf8'))
+         b[name + '.off'].append(self.text_ends[name])
+      self.count += 1
+      if (len(b['id']) >= COLUMNS_FLUSH):
+         self.flush()
+
+
 class Writer(tsv_glue.Writer):
    'Like tsv_glue.Writer, except it takes Tweet objects instead of rows.'
 
@@ -408,4 +658,56 @@ True
 >>> a == Tweet.from_dict(a.to_dict())
 True
 
+# The geotag is kept as floats, and the point made only when asked for.
+>>> b = Tweet.from_list(a.to_list())
+>>> (b.lon, b.lat, b._geom)
+(16.37778864, 48.24424304, None)
+>>> b.geotagged_p()
+True
+>>> b.geom.coords
+(16.37778864, 48.24424304)
+>>> b._geom is b.geom
+True
+>>> b.geom = None
+>>> (b.lon, b.lat, b.geotagged_p(), b.to_list()[8:])
+(None, None, False, [None, None, 'co'])
+>>> b.geom = a.geom
+>>> b == a
+True
+
+# Same for the columnar store.
+>>> import tempfile
+>>> d = tempfile.mkdtemp()
+>>> w = Column_Writer(d)
+>>> for t in (a, T_TW_SIMPLE, a):
+...    w.writerow(t)
+>>> w.close()
+>>> r = Column_Reader(d)
+>>> len(r)
+3
+>>> b = list(r)
+>>> b[0] == a and b[2] == a
+True
+>>> (b[1].id, b[1].text, b[1].user_time_zone, b[1].geom)
+(-1, 'a b', 'g', None)
+>>> int(r.column('created_at')[0])
+1333261878
+>>> r.column('user_time_zone')[1]
+'g'
+>>> c = list(Column_Reader(d, fields=['created_at', 'user_lang']))
+>>> (c[0].created_at, c[1].user_lang, c[1].id, c[1].text)
+(datetime.datetime(2012, 4, 1, 6, 31, 18, tzinfo=<UTC>), 'e', None, None)
+>>> [(t.id, t.lon, t.lat) for t in Column_Reader(d, fields=['geom']).rows()]
+[(None, 16.37778864, 48.24424304), (None, None, None), (None, 16.37778864, 48.24424304)]
+
+# Rows read from TSV are the same as Tweets.
+>>> w = Writer(d + '/tweets.tsv')
+>>> w.writerow(a)
+>>> w.close()
+>>> [Tweet.from_row(r) == a for r in Row_Reader(d + '/tweets.tsv')]
+[True]
+>>> Column_Writer(d).close()
+>>> list(Column_Reader(d))
+[]
+
 ''')
@@ -5,6 +5,10 @@
 
 from unicodedata import *
 
+import array
+
+import testable
+
 script_data = {
 "names":['Common', 'Latin', 'Greek', 'Cyrillic', 'Armenian', 'Hebrew', 'Arabic',
 'Syriac', 'Thaana', 'Devanagari', 'Bengali', 'Gurmukhi', 'Gujarati', 'Oriya',
@@ -557,8 +561,10 @@ script_data = {
 (0xe0020,0xe007f,0,13), (0xe0100,0xe01ef,40,23)
 ]}
 
-def script_cat(chr):
-    """ For the unicode character chr return a tuple (Scriptname, Category). """
+def _script_cat_search(chr):
+    """ For the unicode character chr return a tuple (Scriptname, Category).
+        This is the original binary search over script_data['idx']; the
+        functions below use the lookup table instead. """
     l = 0
     r = len(script_data['idx']) - 1
     c = ord(chr)
@@ -574,6 +580,98 @@ def script_cat(chr):
                 script_data['cats'][script_data['idx'][m][3]])
     return 'Unknown', 'Zzzz'
 
+def _table_build():
+    """ Build the lookup table for script_cat() from script_data. Return a
+        tuple (pairs, page_offsets, pages): the distinct (script, category)
+        tuples, with the one for unassigned codepoints first, and a
+        two-level table mapping each codepoint c to an index into pairs,
+        pages[page_offsets[c >> 8] + (c & 0xff)]. Most of the 4352 pages of
+        256 codepoints are identical (e.g., all unassigned or all Han), so
+        only distinct pages are stored; the table is under 100 KiB and takes
+        a few milliseconds to build. """
+    pairs = [('Unknown', 'Zzzz')]
+    pair_idxs = {}
+    flat = array.array('H', bytes(2 * 0x110000))
+    for (a, b, name, cat) in script_data['idx']:
+        pair = (script_data['names'][name], script_data['cats'][cat])
+        if pair not in pair_idxs:
+            pair_idxs[pair] = len(pairs)
+            pairs.append(pair)
+        flat[a:b+1] = array.array('H', [pair_idxs[pair]]) * (b - a + 1)
+    page_offsets = array.array('l')
+    pages = array.array('H')
+    seen = {}
+    for start in range(0, 0x110000, 256):
+        page = flat[start:start+256]
+        key = page.tobytes()
+        if key not in seen:
+            seen[key] = len(pages)
+            pages.extend(page)
+        page_offsets.append(seen[key])
+    return (tuple(pairs), page_offsets, pages)
+
+_pairs, _page_offsets, _pages = _table_build()
+
+def script_cat(chr):
+    """ For the unicode character chr return a tuple (Scriptname, Category).
+        E.g.:
+
+        >>> script_cat('a'), script_cat('\u3042'), script_cat('\U0001f602')
+        (('Latin', 'L'), ('Hiragana', 'Lo'), ('Common', 'So'))
+        >>> script_cat('\U0010ffff')
+        ('Unknown', 'Zzzz')
+
+        The result is the same as the original binary search for every
+        codepoint:
+
+        >>> all(script_cat(chr(c)) == _script_cat_search(chr(c))
+        ...     for c in range(0x110000))
+        True
+    """
+    c = ord(chr)
+    return _pairs[_pages[_page_offsets[c >> 8] + (c & 0xff)]]
+
+def script_cat_runs(text):
+    """ Split text into runs of characters with the same script and category,
+        and return a list of ((Scriptname, Category), length) pairs, one for
+        each run. This is a lot faster than calling script_cat() on each
+        character. E.g.:
+
+        >>> script_cat_runs('Hi, \u3042\u3044!')
+        [(('Latin', 'L'), 2), (('Common', 'Po'), 1), (('Common', 'Zs'), 1), (('Hiragana', 'Lo'), 2), (('Common', 'Po'), 1)]
+        >>> script_cat_runs('')
+        []
+
+        The runs are those of script_cat() for every codepoint, even those
+        whose neighbors differ:
+
+        >>> text = ''.join(chr(c) for c in range(0x110000))
+        >>> runs = script_cat_runs(text)
+        >>> [p for (p, n) in runs for i in range(n)] \\
+        ...    == [_script_cat_search(c) for c in text]
+        True
+        >>> all(a[0] != b[0] for (a, b) in zip(runs, runs[1:]))
+        True
+    """
+    pairs = _pairs
+    pages = _pages
+    page_offsets = _page_offsets
+    runs = []
+    last = -1
+    n = 0
+    for c in map(ord, text):
+        i = pages[page_offsets[c >> 8] + (c & 0xff)]
+        if i != last:
+            if n:
+                runs.append((pairs[last], n))
+            last = i
+            n = 1
+        else:
+            n += 1
+    if n:
+        runs.append((pairs[last], n))
+    return runs
+
 def script(chr):
     a, _ = script_cat(chr)
     return a
@@ -608,3 +706,6 @@ def _compile_scripts_txt():
         '\n'.join(textwrap.wrap(repr(names), 80)),
         '\n'.join(textwrap.wrap(repr(cats), 80)),
         '\n'.join(textwrap.wrap(', '.join('(0x%x,0x%x,%d,%d)' % c for c in idx), 80))))        
+
+
+testable.register('')
@@ -18,6 +18,7 @@
 #include <stdlib.h>
 #include <string.h>
 #include <sys/stat.h>
+#include <unistd.h>
 
 
 /** Constants **/
@@ -29,6 +30,29 @@
    FIXME: this parameter has not been tuned experimentally. */
 #define OUTPUT_BUFSIZE 4194304
 
+/* First line of a partition table file (see lib/qr/partition.py). */
+#define TABLE_MAGIC "qr-partition-table 1\n"
+
+
+/** Types **/
+
+/* A heavy key, i.e. one assigned to a partition individually. */
+struct heavy {
+   char * key;             // NULL if slot is empty
+   size_t len;
+   unsigned int hash;
+   int part;
+};
+
+/* Partition table. Heavy keys are in an open-addressing hash table. */
+struct table {
+   int part_ct;
+   unsigned int bucket_ct;
+   int * buckets;
+   unsigned int heavy_mask;  // number of slots - 1 (a power of 2)
+   struct heavy * heavy;
+};
+
 
 /** Prototypes **/
 
@@ -36,7 +60,9 @@ void fatal(char * msg, ...);
 unsigned int hash(char * str, char * end);
 void output_close(FILE * out[], int ct);
 FILE ** output_open(char * basename, int ct);
-void split(FILE ** out, int output_ct);
+int partition(struct table * t, int output_ct, char * key, char * end);
+void split(FILE ** out, int output_ct, struct table * t);
+struct table * table_read(char * filename);
 void usage();
 
 
@@ -46,19 +72,30 @@ int main(int argc, char * argv[])
 {
    int output_ct;
    FILE ** out;
+   struct table * table = NULL;
+   int opt;
 
    // parse args
-   if (argc != 3)
+   while ((opt = getopt(argc, argv, "t:")) != -1) {
+      if (opt == 't')
+         table = table_read(optarg);
+      else
+         usage();
+   }
+   if (argc - optind != 2)
       usage();
-   output_ct = atoi(argv[1]);
+   output_ct = atoi(argv[optind]);
    if (output_ct < 1)
       fatal("invalid number of output files: %d", output_ct);
-   if (strlen(argv[2]) == 0)
+   if (strlen(argv[optind + 1]) == 0)
       fatal("length of BASENAME cannot be 0");
+   if (table && table->part_ct != output_ct)
+      fatal("partition table has %d partitions, not %d",
+            table->part_ct, output_ct);
 
    // do the work
-   out = output_open(argv[2], output_ct);
-   split(out, output_ct);
+   out = output_open(argv[optind + 1], output_ct);
+   split(out, output_ct, table);
    output_close(out, output_ct);
 
    return EXIT_SUCCESS;
@@ -138,9 +175,28 @@ FILE ** output_open(char * basename, int ct)
    return out;
 }
 
+/* Return the partition of the key that starts at key and ends just before
+   end. If t is NULL, this is simply the hash modulo output_ct. */
+int partition(struct table * t, int output_ct, char * key, char * end)
+{
+   unsigned int h = hash(key, end);
+   size_t len;
+
+   if (!t)
+      return h % output_ct;
+   len = end - key;
+   for (unsigned int i = h & t->heavy_mask;
+        t->heavy[i].key;
+        i = (i + 1) & t->heavy_mask)
+      if (t->heavy[i].hash == h && t->heavy[i].len == len
+          && !memcmp(t->heavy[i].key, key, len))
+         return t->heavy[i].part;
+   return t->buckets[h % t->bucket_ct];
+}
+
 /* Do the actual splitting of stdin. out is an array of open file descriptors,
-   and output_ct is its length. */
-void split(FILE ** out, int output_ct)
+   and output_ct is its length. t is the partition table, or NULL. */
+void split(FILE ** out, int output_ct, struct table * t)
 {
    char * line = NULL;
    size_t linebuf_sz = 0;
@@ -154,7 +210,7 @@ void split(FILE ** out, int output_ct)
       end = strchr(line, '\t');
       if (end == NULL)
          end = (line + read_sz - 1);
-      fputs(line, out[hash(line, end) % output_ct]);
+      fputs(line, out[partition(t, output_ct, line, end)]);
    }
 
    if (!feof(stdin))
@@ -165,16 +221,75 @@ void split(FILE ** out, int output_ct)
       free(line);
 }
 
+/* Read the partition table in filename (the format is documented in
+   lib/qr/partition.py) and return it. */
+struct table * table_read(char * filename)
+{
+   struct table * t = calloc(1, sizeof(struct table));
+   FILE * fp = fopen(filename, "r");
+   char * line = NULL;
+   size_t linebuf_sz = 0;
+   ssize_t read_sz;
+   unsigned int heavy_ct, slot_ct, i;
+   char * tab;
+
+   if (!fp)
+      fatal("can't open %s: %s", filename, strerror(errno));
+   if (getline(&line, &linebuf_sz, fp) == -1 || strcmp(line, TABLE_MAGIC))
+      fatal("%s: not a partition table", filename);
+   if (fscanf(fp, "%d %u %u", &t->part_ct, &t->bucket_ct, &heavy_ct) != 3
+       || t->part_ct < 1 || t->bucket_ct < 1)
+      fatal("%s: bad partition table header", filename);
+
+   t->buckets = calloc(t->bucket_ct, sizeof(int));
+   for (i = 0; i < t->bucket_ct; i++)
+      if (fscanf(fp, "%d", &t->buckets[i]) != 1
+          || t->buckets[i] < 0 || t->buckets[i] >= t->part_ct)
+         fatal("%s: bad bucket %u", filename, i);
+   getline(&line, &linebuf_sz, fp);  // rest of bucket line
+
+   // Keep the heavy key table at most half full.
+   for (slot_ct = 1; slot_ct < 2 * heavy_ct; slot_ct *= 2)
+      ;
+   t->heavy_mask = slot_ct - 1;
+   t->heavy = calloc(slot_ct, sizeof(struct heavy));
+   for (i = 0; i < heavy_ct; i++) {
+      struct heavy h;
+      unsigned int j;
+      if ((read_sz = getline(&line, &linebuf_sz, fp)) == -1
+          || !(tab = strchr(line, '\t')) || line[read_sz - 1] != '\n')
+         fatal("%s: bad heavy key %u", filename, i);
+      h.part = atoi(line);
+      if (h.part < 0 || h.part >= t->part_ct)
+         fatal("%s: bad heavy key %u", filename, i);
+      h.len = (line + read_sz - 1) - (tab + 1);
+      h.key = strndup(tab + 1, h.len);
+      h.hash = hash(h.key, h.key + h.len);
+      for (j = h.hash & t->heavy_mask;
+           t->heavy[j].key;
+           j = (j + 1) & t->heavy_mask)
+         ;
+      t->heavy[j] = h;
+   }
+
+   free(line);
+   fclose(fp);
+   return t;
+}
+
 /* Print a usage message and abort. */
 void usage()
 {
    fatal(
       /* If we were less lazy, we would use the executable name in argv[0]. */
-      "usage: hashsplit N BASENAME\n"
+      "usage: hashsplit [-t TABLE] N BASENAME\n"
       "\n"
       "Split standard input containing a stream of key/value lines separated\n"
       "by a single tab into N output files named BASENAME.i according to the\n"
       "hash values of the keys. The value may be absent, either with or\n"
       "without a tab following the key. Keys and values may contain any bytes\n"
-      "except zero, tab, and newline.");
+      "except zero, tab, and newline.\n"
+      "\n"
+      "With -t, assign keys to files using partition table TABLE instead\n"
+      "(see partition-table).");
 }
@@ -9,12 +9,19 @@ VERBOSE :=
 # Say e.g. "make LIMIT='--limit 1000'" to limit the number of items processed.
 LIMIT :=
 
+# Say "make COLUMNS=yes" to also build a columnar store of each day's tweets
+# (or "make columns" to build only those).
+COLUMNS :=
+
+# Say "make INDEX=yes" to also build a text index of each day's tweets (or
+# "make index" to build only those). Say e.g.
+# "make INDEX_TOKENIZER=tok.unicode_props.UP_Tiny" to choose the tokenizer.
+INDEX :=
+INDEX_TOKENIZER := tok.unicode_props.UP_Tiny
+
 # Don't leave broken files laying around; re-build them on next invocation.
 .DELETE_ON_ERROR:
 
-# How much memory should sort use? Keep in mind maximum -j.
-SORT_MEM := 512M
-
 
 ## File to build
 
@@ -26,6 +33,9 @@ json_d_pat := raw/*/*.json.d
 rawtsv_pat := raw/*/*.raw.tsv
 alltsv_pat := pre/*.all.tsv
 geotsv_pat := pre/*.geo.tsv
+mdjson_pat := pre/*.metadata.json
+allcol_pat := pre/*.all.col
+allidx_pat := pre/*.all.idx
 log_pat := pre/*.log raw/*/*.log
 gnuplot_pdf_pat := pre/*.gp.pdf
 
@@ -38,9 +48,9 @@ graphs := pre/tweet_ct.gp.pdf pre/geotag_rate.gp.pdf pre/gaps.gp.pdf
 
 ## Phony rules to organize things
 
-.PHONY: all clean
+.PHONY: all clean columns index
 
-all: dircheck $(metadata) $(graphs)
+all: dircheck $(metadata) $(graphs) $(if $(COLUMNS),columns) $(if $(INDEX),index)
 
 # Heuristic test to make sure we're in the right kind of directory.
 dircheck:
@@ -49,6 +59,9 @@ dircheck:
 clean: clean-rawtsv
 	@echo Warning: deleting files which may take days to rebuild...
 	rm -f $(gnuplot_pdf_pat)
+	rm -Rf $(allcol_pat)
+	rm -Rf $(allidx_pat)
+	rm -f $(mdjson_pat)
 	rm -f $(geotsv_pat)
 	rm -f $(alltsv_pat)
 	rm -f $(metadata)
@@ -73,7 +86,7 @@ clean: clean-rawtsv
 #
 # To get the above behavior, I needed to have both (a) .INTERMEDIATE to
 # explicitly mark the .raw.tsv as intermediate (without this, make will not
-# rebuild them if they're deleted, and sort will fail), and (b) a rule to
+# rebuild them if they're deleted, and tsvmerge will fail), and (b) a rule to
 # build them (without this, make doesn't know how to rebuild them). I also
 # include a clean-rawtsv target to facilitate manual removal; the recommended
 # invocation is "make all && make clean-rawtsv" (in a parallel make, "make all
@@ -107,23 +120,30 @@ json2rawtsv = json2rawtsv $(VERBOSE) $(LIMIT) $<
 # dependencies are, in summary:
 #
 # 1. .raw.tsv depend on the corresponding .stats.
-# 2. .all.tsv depend on each .raw.tsv for the same date.
+# 2. .all.tsv, .geo.tsv, and .metadata.json depend on each .raw.tsv for the
+#    same date.
+# 3. pre/metadata depends on each .metadata.json.
+#
+# They also add each day's columnar store and text index to the phony targets
+# "columns" and "index" respectively.
 
 %.raw.tsv:
 	$(json2rawtsv)
 
-%.all.tsv:
-	sort -o $@ -n -u -S $(SORT_MEM) -T . $(filter %.raw.tsv, $^)
+# The .raw.tsv are each sorted by tweet ID, so tsvmerge can merge them in one
+# streaming pass. A pattern rule with several targets builds them all at once.
+%.all.tsv %.geo.tsv %.metadata.json:
+	tsvmerge $(VERBOSE) --geo $*.geo.tsv --metadata $*.metadata.json \
+	         $*.all.tsv $(filter %.raw.tsv, $^)
 
-%.geo.tsv: %.all.tsv
-# This works by testing the last character of a line: if it's not a tab, then
-# the last column (geotag source) contains something, so there's a geotag.
-#
-# The crap at the end of the line is because grep's exit codes can be either 0
-# (matches found) or 1 (no matches found). Only code >= 2 means a real error,
-# which we really do want to catch. And on older tweet files, no geotagged
-# tweets is common.
-	grep -Pv "\t$$" $< > $@ ; [ $$? -le 1 ]
+# The columnar store is a directory, so we use the file that's written last
+# to stand for it.
+%.all.col/columns: %.all.tsv
+	tsv2col $(VERBOSE) $< $(@D)
+
+# Likewise for the text index.
+%.all.idx/index: %.all.tsv
+	tsv2index $(VERBOSE) --tokenizer $(INDEX_TOKENIZER) $< $(@D)
 
 pre/metadata:
 	tsv2metadata $(VERBOSE) $@ $?